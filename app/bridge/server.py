@@ -4,7 +4,9 @@ Local FastAPI server bridging Swift UI to Cactus on-device inference.
 Run: uvicorn server:app --host 127.0.0.1 --port 8420
 """
 
-import sys, os, json, tempfile, threading, subprocess, wave
+import sys, os, json, re, tempfile, threading, subprocess, wave, queue, time, struct, ctypes, asyncio, math, bisect
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
 
 # Resolve all paths relative to the repo root so generate_hybrid finds its models
 REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
@@ -12,30 +14,733 @@ os.chdir(REPO_ROOT)
 
 sys.path.insert(0, os.path.join(REPO_ROOT, "cactus/python/src"))
 
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
-from contextlib import asynccontextmanager
-from cactus import cactus_init, cactus_destroy
-import cactus as _cactus_mod
-import ctypes
+import numpy as np
+from fastapi import FastAPI, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel
+from contextlib import asynccontextmanager, contextmanager, ExitStack
 
 sys.path.insert(0, REPO_ROOT)
-from main import generate_hybrid
+from main import (
+    generate_hybrid, get_backends, get_cloud_manager, preload_models, warm_up_models, validation_stats,
+    single_flight_stats,
+    GeminiBackend, GEMINI_MODEL, MODEL_POOL_SIZE,
+)
 
 WHISPER_PATH = os.path.join(REPO_ROOT, "cactus/weights/whisper-small")
+WHISPER_POOL_SIZE = int(os.environ.get("SPIKE_WHISPER_POOL_SIZE", "2"))
+WHISPER_CHECKOUT_TIMEOUT_S = float(os.environ.get("SPIKE_WHISPER_CHECKOUT_TIMEOUT_S", "10"))
+# Inference executor: workers running transcription + routing, how many jobs
+# may wait behind them before new ones are shed with 503, and how long a
+# request may take end to end
+INFERENCE_WORKERS = int(os.environ.get("SPIKE_INFERENCE_WORKERS", str(WHISPER_POOL_SIZE)))
+INFERENCE_QUEUE_SIZE = int(os.environ.get("SPIKE_INFERENCE_QUEUE_SIZE", "8"))
+REQUEST_DEADLINE_S = float(os.environ.get("SPIKE_REQUEST_DEADLINE_S", "15"))
+WHISPER_PROMPT = "<|startoftranscript|><|en|><|transcribe|><|notimestamps|>"
+WHISPER_SAMPLE_RATE = 16000
+# Hand Whisper the PCM samples directly; set to 0 to go through a WAV file
+WHISPER_PCM_INPUT = os.environ.get("SPIKE_WHISPER_PCM_INPUT", "1") == "1"
+# Opt-in copy of the last preprocessed recording, e.g. /tmp/spike_last_recording.wav
+DEBUG_RECORDING_PATH = os.environ.get("SPIKE_DEBUG_RECORDING")
+AFCONVERT = "/usr/bin/afconvert"
+# Run a warm-up command on every FunctionGemma handle and a dummy
+# transcription on every Whisper handle before reporting ready
+WARMUP = os.environ.get("SPIKE_WARMUP", "1") == "1"
+WARMUP_COMMAND = "open Safari"
+# /transcribe_stream: re-transcribe once this much new audio has arrived;
+# freeze the window's text past STREAM_MAX_WINDOW_S and start the next window
+# STREAM_OVERLAP_S before its end, so the pass after release stays short
+STREAM_STEP_S = float(os.environ.get("SPIKE_STREAM_STEP_S", "0.8"))
+STREAM_MAX_WINDOW_S = float(os.environ.get("SPIKE_STREAM_MAX_WINDOW_S", str(3 * STREAM_STEP_S)))
+STREAM_OVERLAP_S = float(os.environ.get("SPIKE_STREAM_OVERLAP_S", "0.5"))
+# /route: largest accepted batch. Items run MODEL_POOL_SIZE at a time.
+ROUTE_MAX_BATCH = int(os.environ.get("SPIKE_ROUTE_MAX_BATCH", "256"))
 
-whisper_model = None
-whisper_lock = threading.Lock()
+
+############## Audio preprocessing ##############
+
+class UnsupportedAudio(ValueError):
+    """Audio the server cannot decode; answered with 415."""
+
+
+def decode_wav(data):
+    """Decode a RIFF/WAVE byte string to (float32 samples [frames, channels],
+    sample rate). Handles 8/16/24/32-bit PCM and 32/64-bit float, including
+    WAVE_FORMAT_EXTENSIBLE headers and padded chunks."""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise UnsupportedAudio("not a RIFF/WAVE file")
+    fmt = payload = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        size = struct.unpack("<I", data[pos + 4:pos + 8])[0]
+        body = data[pos + 8:pos + 8 + size]
+        if chunk_id == b"fmt ":
+            if len(body) < 16:
+                raise UnsupportedAudio("truncated fmt chunk")
+            fmt = struct.unpack("<HHIIHH", body[:16])
+            if fmt[0] == 0xFFFE and len(body) >= 26:  # WAVE_FORMAT_EXTENSIBLE
+                fmt = (struct.unpack("<H", body[24:26])[0],) + fmt[1:]
+        elif chunk_id == b"data":
+            payload = body
+        pos += 8 + size + (size & 1)
+    if fmt is None or payload is None:
+        raise UnsupportedAudio("WAV file without fmt or data chunk")
+
+    format_tag, channels, rate, _, _, bits = fmt
+    if not channels or not rate or not bits or bits % 8:
+        raise UnsupportedAudio(f"invalid WAV header ({channels} channels, {rate} Hz, {bits} bits)")
+    width = bits // 8
+    usable = len(payload) - len(payload) % (width * channels)
+    raw = np.frombuffer(payload, dtype=np.uint8, count=usable)
+    if format_tag == 3 and bits in (32, 64):
+        samples = raw.view("<f4" if bits == 32 else "<f8").astype(np.float32)
+    elif format_tag == 1 and bits == 8:
+        samples = (raw.astype(np.float32) - 128.0) / 128.0
+    elif format_tag == 1 and bits == 16:
+        samples = raw.view("<i2").astype(np.float32) / 32768.0
+    elif format_tag == 1 and bits == 24:
+        triplets = raw.reshape(-1, 3).astype(np.int32)
+        ints = triplets[:, 0] | (triplets[:, 1] << 8) | (triplets[:, 2] << 16)
+        ints = np.where(ints & 0x800000, ints - 0x1000000, ints)
+        samples = ints.astype(np.float32) / 8388608.0
+    elif format_tag == 1 and bits == 32:
+        samples = raw.view("<i4").astype(np.float32) / 2147483648.0
+    else:
+        raise UnsupportedAudio(f"unsupported WAV encoding (format {format_tag}, {bits} bits)")
+    return samples.reshape(-1, channels), rate
+
+
+def to_whisper_pcm(samples, rate):
+    """Downmix to mono and resample to 16 kHz int16 PCM."""
+    mono = samples.mean(axis=1) if samples.ndim == 2 else samples
+    if rate != WHISPER_SAMPLE_RATE and len(mono):
+        step = rate / WHISPER_SAMPLE_RATE
+        if step >= 2:
+            # Box low-pass before decimating to keep aliasing out of the speech band
+            k = int(step)
+            mono = np.convolve(mono, np.full(k, 1.0 / k, dtype=np.float32), mode="same")
+        n_out = int(len(mono) / step)
+        positions = np.arange(n_out, dtype=np.float64) * step
+        mono = np.interp(positions, np.arange(len(mono)), mono).astype(np.float32)
+    return (np.clip(mono, -1.0, 1.0) * 32767.0).astype("<i2")
+
+
+class StreamResampler:
+    """to_whisper_pcm for int16 frames arriving in chunks. The source position
+    of the next output sample and the box filter's history carry over from
+    one chunk to the next, so chunks whose length is not a multiple of
+    rate / 16 kHz (44.1 kHz) lose no fractional samples."""
+
+    def __init__(self, rate, channels=1):
+        self.channels = channels
+        self.step = rate / WHISPER_SAMPLE_RATE
+        self.taps = int(self.step) if self.step >= 2 else 1
+        self._history = np.zeros(self.taps - 1, dtype=np.float32)
+        self._filtered = np.empty(0, dtype=np.float32)
+        # Causal box filter output i is centered on source sample i - (taps-1)/2
+        self._pos = (self.taps - 1) / 2
+
+    def push(self, frames):
+        mono = frames.reshape(-1, self.channels).mean(axis=1, dtype=np.float32) / 32768.0
+        if self.taps > 1:
+            padded = np.concatenate((self._history, mono))
+            self._history = padded[len(padded) - (self.taps - 1):]
+            mono = np.convolve(padded, np.full(self.taps, 1.0 / self.taps, dtype=np.float32), mode="valid")
+        buf = np.concatenate((self._filtered, mono))
+        last = len(buf) - 1
+        n_out = int((last - self._pos) // self.step) + 1 if last >= self._pos else 0
+        positions = self._pos + np.arange(n_out, dtype=np.float64) * self.step
+        out = np.interp(positions, np.arange(len(buf)), buf).astype(np.float32)
+        self._pos += n_out * self.step
+        drop = min(int(self._pos), len(buf))
+        self._filtered, self._pos = buf[drop:], self._pos - drop
+        return (np.clip(out, -1.0, 1.0) * 32767.0).astype("<i2")
+
+
+def write_wav(path, pcm):
+    with wave.open(path, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(WHISPER_SAMPLE_RATE)
+        wf.writeframes(pcm.tobytes())
+
+
+def transcript_text(raw):
+    """Text of a Whisper JSON response ("" when empty)."""
+    parsed = json.loads(raw) if raw else {}
+    return parsed.get("response", "") or ""
+
+
+def preprocess_audio(content):
+    """Uploaded audio bytes -> 16 kHz mono int16 PCM, in memory. Non-WAV input
+    goes through afconvert where it exists (macOS)."""
+    try:
+        samples, rate = decode_wav(content)
+    except UnsupportedAudio:
+        if not os.path.exists(AFCONVERT):
+            raise
+        with tempfile.TemporaryDirectory() as tmp:
+            src, dst = os.path.join(tmp, "in"), os.path.join(tmp, "out.wav")
+            with open(src, "wb") as f:
+                f.write(content)
+            try:
+                subprocess.run([AFCONVERT, "-f", "WAVE", "-d", "LEI16@16000", src, dst],
+                               check=True, capture_output=True)
+            except subprocess.CalledProcessError as e:
+                raise UnsupportedAudio(f"afconvert failed: {e.stderr.decode(errors='replace').strip()}") from None
+            with open(dst, "rb") as f:
+                samples, rate = decode_wav(f.read())
+    return to_whisper_pcm(samples, rate)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Overloaded(Exception):
+    """The inference queue is full; `retry_after` is a hint in seconds."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class InferenceExecutor:
+    """Fixed worker threads behind a bounded queue. Submitting to a full
+    queue fails at once instead of adding to everyone's latency, and jobs
+    whose deadline passes while queued are dropped without running."""
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.completed = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+        self.run_ms_total = 0.0
+        self.depth_max = 0
+        self._threads = [
+            threading.Thread(target=self._work, name=f"spike-inference-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def retry_after_s(self):
+        """Seconds until the current backlog is likely to have drained."""
+        with self._lock:
+            avg_run_s = self.run_ms_total / self.completed / 1000 if self.completed else 1.0
+        backlog = self._jobs.qsize() + self.running
+        return max(1, math.ceil(backlog * avg_run_s / max(1, self.workers)))
+
+    def submit(self, fn, *args, deadline=None):
+        """Queue fn(*args); raises Overloaded when the queue is full. Returns
+        a concurrent.futures.Future."""
+        future = Future()
+        try:
+            self._jobs.put_nowait((future, fn, args, time.perf_counter(), deadline))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded("inference queue full", self.retry_after_s())
+        with self._lock:
+            self.submitted += 1
+            self.depth_max = max(self.depth_max, self._jobs.qsize())
+        return future
+
+    async def run(self, fn, *args, timeout=REQUEST_DEADLINE_S):
+        """Await fn(*args) on the executor within `timeout` seconds."""
+        deadline = time.perf_counter() + timeout
+        future = self.submit(fn, *args, deadline=deadline)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            future.cancel()  # no-op once running; the result is discarded
+            raise DeadlineExceeded(f"no result within {timeout:g}s")
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            future, fn, args, queued_at, deadline = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            waited_ms = (started - queued_at) * 1000
+            with self._lock:
+                self.wait_ms_total += waited_ms
+                self.wait_ms_max = max(self.wait_ms_max, waited_ms)
+            if deadline is not None and started > deadline:
+                with self._lock:
+                    self.expired += 1
+                future.set_exception(DeadlineExceeded(f"expired after {waited_ms:.0f}ms in queue"))
+                continue
+            with self._lock:
+                self.running += 1
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.run_ms_total += (time.perf_counter() - started) * 1000
+
+    def stats(self):
+        with self._lock:
+            started = self.completed + self.running + self.expired
+            return {
+                "workers": self.workers,
+                "running": self.running,
+                "queue_depth": self._jobs.qsize(),
+                "queue_depth_max": self.depth_max,
+                "queue_capacity": self._jobs.maxsize,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "wait_ms_avg": self.wait_ms_total / started if started else 0.0,
+                "wait_ms_max": self.wait_ms_max,
+                "run_ms_avg": self.run_ms_total / self.completed if self.completed else 0.0,
+            }
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+
+
+class WhisperPool:
+    """Fixed set of Whisper handles shared by concurrent requests. Each
+    transcription checks one out exclusively, so up to `size` run at once."""
+
+    def __init__(self, backend, model_path, size):
+        self.backend = backend
+        self.size = size
+        self._idle = queue.Queue()
+        self._scratch = {}
+        for i in range(size):
+            handle = backend.init(model_path)
+            # Per-handle output buffer and WAV path, reused across requests
+            self._scratch[id(handle)] = (
+                ctypes.create_string_buffer(65536),
+                os.path.join(tempfile.gettempdir(), f"spike_whisper_{os.getpid()}_{i}.wav"),
+            )
+            self._idle.put(handle)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        start = time.perf_counter()
+        try:
+            handle = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"no Whisper handle free after {timeout}s")
+        waited_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_ms_total += waited_ms
+            self.wait_ms_max = max(self.wait_ms_max, waited_ms)
+        try:
+            yield handle
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._idle.put(handle)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "utilization": self.in_use / self.size if self.size else 0.0,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_ms_avg": self.wait_ms_total / self.checkouts if self.checkouts else 0.0,
+                "wait_ms_max": self.wait_ms_max,
+            }
+
+    def transcribe(self, handle, pcm):
+        """Transcribe int16 PCM on a checked-out handle; returns the raw JSON."""
+        buffer, wav_path = self._scratch[id(handle)]
+        if WHISPER_PCM_INPUT:
+            return self.backend.transcribe(handle, None, WHISPER_PROMPT, buffer=buffer, pcm=pcm)
+        write_wav(wav_path, pcm)
+        return self.backend.transcribe(handle, wav_path, WHISPER_PROMPT, buffer=buffer)
+
+    def close(self):
+        for _ in range(self.size):
+            handle = self._idle.get()
+            _, wav_path = self._scratch.pop(id(handle))
+            if os.path.exists(wav_path):
+                os.unlink(wav_path)
+            self.backend.destroy(handle)
+
+
+class StreamingTranscriber:
+    """Incremental transcription of PCM arriving in frames. The current
+    window is re-transcribed every STREAM_STEP_S of new audio. Once it spans
+    STREAM_MAX_WINDOW_S its text is frozen and the next window starts
+    STREAM_OVERLAP_S before its end; words the overlap repeats are dropped
+    when the windows are stitched. A pass never reads more than about one
+    window plus a step of audio, however long the speaker talks."""
+
+    def __init__(self, pool, sample_rate=WHISPER_SAMPLE_RATE, channels=1):
+        self.pool = pool
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._frame_bytes = 2 * channels
+        self._remainder = b""
+        self._resampler = None
+        if sample_rate != WHISPER_SAMPLE_RATE or channels != 1:
+            self._resampler = StreamResampler(sample_rate, channels)
+        self._buf = np.empty(WHISPER_SAMPLE_RATE * 10, dtype="<i2")
+        self.samples = 0
+        self._committed = []       # words of frozen windows
+        self._window_start = 0
+        self._covered = 0          # samples covered by the latest window pass
+        self._window_words = []
+        self.passes = 0
+
+    def feed(self, data):
+        """Append little-endian int16 frames at the stream's rate/channels."""
+        data = self._remainder + data
+        usable = len(data) - len(data) % self._frame_bytes
+        self._remainder = data[usable:]
+        if not usable:
+            return
+        frames = np.frombuffer(data, dtype="<i2", count=usable // 2)
+        if self._resampler is not None:
+            frames = self._resampler.push(frames)
+        end = self.samples + len(frames)
+        if end > len(self._buf):
+            grown = np.empty(max(end, 2 * len(self._buf)), dtype="<i2")
+            grown[:self.samples] = self._buf[:self.samples]
+            self._buf = grown
+        self._buf[self.samples:end] = frames
+        self.samples = end
+
+    def pending_s(self):
+        """Seconds of audio not covered by the latest pass."""
+        return (self.samples - self._covered) / WHISPER_SAMPLE_RATE
+
+    def pcm(self):
+        return self._buf[:self.samples]
+
+    def transcribe(self):
+        """Transcribe the current window up to the newest sample. Blocking;
+        run it off the event loop, one call at a time per stream."""
+        end = self.samples
+        if end > self._window_start:
+            # A slice of the growing buffer: later feeds never write below `end`
+            pcm = self._buf[self._window_start:end]
+            with self.pool.checkout(timeout=WHISPER_CHECKOUT_TIMEOUT_S) as handle:
+                text = transcript_text(self.pool.transcribe(handle, pcm))
+            self._window_words = self._stitch(text.split())
+            self.passes += 1
+        self._covered = end
+        if (end - self._window_start) / WHISPER_SAMPLE_RATE >= STREAM_MAX_WINDOW_S:
+            self._committed.extend(self._window_words)
+            overlap = int(STREAM_OVERLAP_S * WHISPER_SAMPLE_RATE)
+            self._window_start, self._window_words = max(self._window_start + 1, end - overlap), []
+        return self.text()
+
+    def _stitch(self, words):
+        """Drop the leading `words` of a window that repeat the end of the
+        frozen text. The overlap may start inside a word, so its first word
+        can be a fragment; a frozen last word that was cut off ("Saf") is
+        replaced by its complete form from the overlap ("Safari")."""
+        if not self._committed or not words:
+            return words
+        key = lambda w: re.sub(r"[^\w']", "", w.lower())
+        tail = [key(w) for w in self._committed[-8:]]
+        head = [key(w) for w in words[:8]]
+        fragment = lambda t, h: h and (t.endswith(h) or t.startswith(h))
+        for n in range(min(len(tail), len(head)), 0, -1):
+            t, h = tail[-n:], head[:n]
+            if n > 1 and not (t[0] == h[0] or fragment(t[0], h[0])):
+                continue
+            if t[1:-1] != h[1:-1]:
+                continue
+            if t[-1] == h[-1] or (n == 1 and fragment(t[0], h[0])):
+                return words[n:]
+            if t[-1] and h[-1].startswith(t[-1]):
+                self._committed.pop()
+                return words[n - 1:]
+        return words
+
+    def text(self):
+        return " ".join(self._committed + self._window_words)
+
+
+############## Metrics ##############
+
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """Latency histogram in Prometheus' cumulative-bucket layout. Not
+    thread-safe on its own; Metrics serializes access."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.3f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Request metrics for /metrics. Recording is a few dict updates under
+    one lock per request, so it stays on in production."""
+
+    # Response-body field -> histogram name
+    LATENCIES = {
+        "transcription_time_ms": "spike_transcription_latency_ms",
+        "routing_time_ms": "spike_routing_latency_ms",
+        "total_time_ms": "spike_request_latency_ms",
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}      # (metric, endpoint) -> Histogram
+        self.by_source = {}    # (endpoint, source) -> count
+        self.responses = {}    # (endpoint, code) -> count
+        self.tool_calls = {}   # tool -> [calls, cloud calls]
+        self.in_flight = 0
+
+    @contextmanager
+    def track(self):
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def observe(self, endpoint, body):
+        """Record one completed request from its response body."""
+        source = body.get("source", "unknown")
+        cloud = source.startswith("cloud")
+        with self._lock:
+            for metric in self.LATENCIES:
+                if metric in body:
+                    hist = self.latency.get((metric, endpoint))
+                    if hist is None:
+                        hist = self.latency[(metric, endpoint)] = Histogram()
+                    hist.observe(body[metric])
+            key = (endpoint, source)
+            self.by_source[key] = self.by_source.get(key, 0) + 1
+            for call in body.get("function_calls", []):
+                counts = self.tool_calls.setdefault(call.get("name", "unknown"), [0, 0])
+                counts[0] += 1
+                counts[1] += cloud
+
+    def response(self, endpoint, code):
+        with self._lock:
+            key = (endpoint, code)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def render(self):
+        """Prometheus text exposition format."""
+        out = []
+
+        def family(name, kind, help_text):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            for metric, name in self.LATENCIES.items():
+                family(name, "histogram", f"{metric} of completed requests")
+                for (m, endpoint), hist in sorted(self.latency.items()):
+                    if m == metric:
+                        out.extend(hist.render(name, f'endpoint="{_label(endpoint)}"'))
+            family("spike_requests_total", "counter", "Completed requests by routing source")
+            for (endpoint, source), n in sorted(self.by_source.items()):
+                out.append(f'spike_requests_total{{endpoint="{_label(endpoint)}",source="{_label(source)}"}} {n}')
+            family("spike_responses_total", "counter", "Responses by HTTP status or WebSocket close code")
+            for (endpoint, code), n in sorted(self.responses.items()):
+                out.append(f'spike_responses_total{{endpoint="{_label(endpoint)}",code="{code}"}} {n}')
+            family("spike_requests_in_flight", "gauge", "Requests being handled")
+            out.append(f"spike_requests_in_flight {self.in_flight}")
+            tool_calls = {tool: list(counts) for tool, counts in self.tool_calls.items()}
+
+        tool_calls = sorted(tool_calls.items())
+        family("spike_tool_calls_total", "counter", "Function calls returned, by tool")
+        for tool, (calls, _) in tool_calls:
+            out.append(f'spike_tool_calls_total{{tool="{_label(tool)}"}} {calls}')
+        family("spike_tool_cloud_fallback_total", "counter", "Function calls answered by the cloud, by tool")
+        for tool, (_, cloud) in tool_calls:
+            out.append(f'spike_tool_cloud_fallback_total{{tool="{_label(tool)}"}} {cloud}')
+        family("spike_tool_cloud_fallback_ratio", "gauge", "Share of a tool's calls answered by the cloud")
+        for tool, (calls, cloud) in tool_calls:
+            out.append(f'spike_tool_cloud_fallback_ratio{{tool="{_label(tool)}"}} {cloud / calls:.4f}')
+
+        validation = sorted(validation_stats().items())
+        family("spike_tool_validation_proposed_total", "counter", "On-device calls checked by validation, by tool")
+        for tool, stats in validation:
+            out.append(f'spike_tool_validation_proposed_total{{tool="{_label(tool)}"}} {stats["proposed"]}')
+        family("spike_tool_validation_rejects_total", "counter", "On-device calls rejected by validation, by tool")
+        for tool, stats in validation:
+            out.append(f'spike_tool_validation_rejects_total{{tool="{_label(tool)}"}} {stats["rejected"]}')
+        family("spike_tool_validation_reject_ratio", "gauge", "Share of a tool's on-device calls rejected")
+        for tool, stats in validation:
+            ratio = stats["rejected"] / stats["proposed"] if stats["proposed"] else 0.0
+            out.append(f'spike_tool_validation_reject_ratio{{tool="{_label(tool)}"}} {ratio:.4f}')
+
+        flights = single_flight_stats()
+        family("spike_single_flight_leaders_total", "counter", "Calls that ran their own computation, by boundary")
+        for boundary, stats in flights.items():
+            out.append(f'spike_single_flight_leaders_total{{boundary="{boundary}"}} {stats["leaders"]}')
+        family("spike_single_flight_coalesced_total", "counter", "Calls served by an identical in-flight call, by boundary")
+        for boundary, stats in flights.items():
+            out.append(f'spike_single_flight_coalesced_total{{boundary="{boundary}"}} {stats["coalesced"]}')
+
+        if inference is not None:
+            q = inference.stats()
+            family("spike_inference_queue_depth", "gauge", "Jobs waiting for an inference worker")
+            out.append(f"spike_inference_queue_depth {q['queue_depth']}")
+            family("spike_inference_running", "gauge", "Jobs running on inference workers")
+            out.append(f"spike_inference_running {q['running']}")
+            family("spike_inference_rejected_total", "counter", "Jobs shed because the queue was full")
+            out.append(f"spike_inference_rejected_total {q['rejected']}")
+            family("spike_inference_expired_total", "counter", "Jobs dropped after their deadline passed in queue")
+            out.append(f"spike_inference_expired_total {q['expired']}")
+        if whisper_pool is not None:
+            w = whisper_pool.stats()
+            family("spike_whisper_handles_in_use", "gauge", "Whisper handles checked out")
+            out.append(f"spike_whisper_handles_in_use {w['in_use']}")
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+whisper_pool = None
+inference = None
+route_executor = None
+
+
+# Startup progress, reported by /health: "starting" until every model is
+# loaded and warmed, then "ok" (or "error")
+startup = {"status": "starting", "phases_ms": {}, "total_ms": None, "error": None}
+
+
+@contextmanager
+def startup_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup["phases_ms"][name] = (time.perf_counter() - start) * 1000
+
+
+def start_up():
+    """Load every model and warm the request path, timing each phase. Runs
+    in a thread so /health can answer while it is in progress."""
+    global whisper_pool
+    start = time.perf_counter()
+    try:
+        with startup_phase("whisper_load"):
+            whisper_pool = WhisperPool(get_backends()[0], WHISPER_PATH, WHISPER_POOL_SIZE)
+        with startup_phase("functiongemma_load"):
+            preload_models(TOOLS)
+        if isinstance(get_backends()[1], GeminiBackend) and os.environ.get("GEMINI_API_KEY"):
+            with startup_phase("cloud_connect"):
+                manager = get_cloud_manager()
+                manager.config_for(TOOLS)
+                try:
+                    # Opens the TLS connection the first fallback would otherwise pay for
+                    manager.client.models.get(model=GEMINI_MODEL)
+                except Exception as e:
+                    print(f"[startup] Gemini warm-up failed: {type(e).__name__}: {e}")
+        if WARMUP:
+            with startup_phase("whisper_warmup"):
+                silence = np.zeros(WHISPER_SAMPLE_RATE, dtype="<i2")
+                with ExitStack() as stack:
+                    for _ in range(whisper_pool.size):
+                        handle = stack.enter_context(whisper_pool.checkout())
+                        whisper_pool.transcribe(handle, silence)
+            with startup_phase("routing_warmup"):
+                warm_up_models(TOOLS, WARMUP_COMMAND)
+        startup["status"] = "ok"
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        startup["status"], startup["error"] = "error", f"{type(e).__name__}: {e}"
+    startup["total_ms"] = (time.perf_counter() - start) * 1000
+    phases = ", ".join(f"{k} {v:.0f}ms" for k, v in startup["phases_ms"].items())
+    print(f"[startup] {startup['status']} in {startup['total_ms']:.0f}ms ({phases})")
+
+
+def busy(e):
+    return JSONResponse(
+        {"error": f"Server busy: {e}"},
+        status_code=503,
+        headers={"Retry-After": str(getattr(e, "retry_after", 1))},
+    )
+
+
+def not_ready():
+    """503 for requests arriving before start_up has finished."""
+    return JSONResponse(
+        {"error": f"Server {startup['status']}", "startup": startup},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global whisper_model
-    whisper_model = cactus_init(WHISPER_PATH)
+    global whisper_pool, inference, route_executor
+    inference = InferenceExecutor(INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE)
+    route_executor = ThreadPoolExecutor(max_workers=max(1, MODEL_POOL_SIZE), thread_name_prefix="spike-route")
+    starter = threading.Thread(target=start_up, name="spike-startup", daemon=True)
+    starter.start()
     yield
-    if whisper_model is not None:
-        cactus_destroy(whisper_model)
-        whisper_model = None
+    starter.join()
+    inference.shutdown()
+    inference = None
+    route_executor.shutdown()
+    route_executor = None
+    if whisper_pool is not None:
+        whisper_pool.close()
+        whisper_pool = None
 
 
 app = FastAPI(lifespan=lifespan)
@@ -99,64 +804,163 @@ TOOLS = [
 ]
 
 
-@app.post("/transcribe_and_act")
-def transcribe_and_act(audio: UploadFile = File(...)):
-    import time
+def transcribe_and_route(content):
+    """Blocking transcription + routing of one upload; runs on the inference
+    executor and returns the /transcribe_and_act body."""
+    t0 = time.time()
+
+    pcm = preprocess_audio(content)
+    if DEBUG_RECORDING_PATH:
+        write_wav(DEBUG_RECORDING_PATH, pcm)
+
+    with whisper_pool.checkout(timeout=WHISPER_CHECKOUT_TIMEOUT_S) as whisper_model:
+        transcript_raw = whisper_pool.transcribe(whisper_model, pcm)
+    print(f"[DEBUG] Whisper raw: {transcript_raw}")
+
+    transcript = transcript_text(transcript_raw)
+    print(f"[DEBUG] Transcript: '{transcript}'")
+    transcription_time_ms = (time.time() - t0) * 1000
+
+    if not transcript.strip():
+        return {
+            "transcription": "",
+            "function_calls": [],
+            "source": "none",
+            "confidence": 0,
+            "total_time_ms": transcription_time_ms,
+            "transcription_time_ms": transcription_time_ms,
+            "routing_time_ms": 0,
+            "error": "Empty transcription"
+        }
+
+    t1 = time.time()
+    messages = [{"role": "user", "content": transcript}]
+    result = generate_hybrid(messages, TOOLS)
+    routing_time_ms = (time.time() - t1) * 1000
 
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp:
-        content = audio.file.read()
-        tmp.write(content)
-        tmp_path = tmp.name
+    return {
+        "transcription": transcript,
+        "function_calls": result.get("function_calls", []),
+        "source": result.get("source", "unknown"),
+        "confidence": result.get("confidence", 0),
+        "total_time_ms": transcription_time_ms + routing_time_ms,
+        "transcription_time_ms": transcription_time_ms,
+        "routing_time_ms": routing_time_ms,
+    }
 
-    af_path = tmp_path.replace(".wav", "") + "_af.wav"
 
+@app.post("/transcribe_and_act")
+async def transcribe_and_act(audio: UploadFile = File(...)):
+    with metrics.track():
+        response = await _transcribe_and_act(audio)
+    metrics.response("transcribe_and_act", response.status_code)
+    return response
+
+
+async def _transcribe_and_act(audio):
+    if startup["status"] != "ok":
+        return not_ready()
     try:
-        t0 = time.time()
+        content = await audio.read()
+        body = await inference.run(transcribe_and_route, content)
+        metrics.observe("transcribe_and_act", body)
+        return JSONResponse(body)
+
+    except (Overloaded, PoolTimeout) as e:
+        return busy(e)
 
-        # Convert uploaded audio to guaranteed 16kHz mono PCM WAV
-        subprocess.run(
-            ["/usr/bin/afconvert", "-f", "WAVE", "-d", "LEI16@16000", tmp_path, af_path],
-            check=True, capture_output=True,
+    except DeadlineExceeded as e:
+        return JSONResponse(
+            {"error": f"Deadline exceeded: {e}"},
+            status_code=504,
         )
 
-        # Re-write with clean 44-byte header (afconvert pads to 4096 which confuses cactus)
-        clean_path = tmp_path.replace(".wav", "") + "_clean.wav"
-        with wave.open(af_path, "rb") as rf:
-            pcm = rf.readframes(rf.getnframes())
-        with wave.open(clean_path, "wb") as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(2)
-            wf.setframerate(16000)
-            wf.writeframes(pcm)
-
-        import shutil
-        shutil.copy2(clean_path, "/tmp/spike_last_recording.wav")
-
-        # Force filesystem flush before C code reads
-        os.sync()
-
-        prompt = "<|startoftranscript|><|en|><|transcribe|><|notimestamps|>"
-        with whisper_lock:
-            _cactus_mod._lib.cactus_reset(whisper_model)
-            buf = ctypes.create_string_buffer(65536)
-            opts = b'{"use_vad": false}'
-            _cactus_mod._lib.cactus_transcribe(
-                whisper_model,
-                clean_path.encode(), prompt.encode(),
-                buf, len(buf),
-                opts, _cactus_mod.TokenCallback(), None,
-                None, 0,
-            )
-            transcript_raw = buf.value.decode()
-        print(f"[DEBUG] Whisper raw: {transcript_raw}")
+    except UnsupportedAudio as e:
+        return JSONResponse(
+            {"error": f"Unsupported audio: {e}"},
+            status_code=415,
+        )
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return JSONResponse(
+            {"error": f"{type(e).__name__}: {e}"},
+            status_code=500,
+        )
+
+
+@app.websocket("/transcribe_stream")
+async def transcribe_stream(ws: WebSocket):
+    """Streaming variant of /transcribe_and_act.
+
+    Protocol: an optional JSON text message {"sample_rate": 48000,
+    "channels": 1} (default 16 kHz mono), then binary frames of little-endian
+    int16 PCM while the hotkey is held, then the text message "end". The
+    server sends {"type": "partial", "transcription": ...} as it goes and one
+    {"type": "result", ...} with the /transcribe_and_act fields at the end.
+    Timings in the result count from "end", i.e. what the user waits for.
+    """
+    with metrics.track():
+        code = await _transcribe_stream(ws)
+    metrics.response("transcribe_stream", code)
 
-        parsed = json.loads(transcript_raw) if transcript_raw else {}
-        transcript = parsed.get("response", "") or ""
-        print(f"[DEBUG] Transcript: '{transcript}'")
+
+async def _transcribe_stream(ws):
+    """Runs one stream; returns the WebSocket close code."""
+    await ws.accept()
+    if startup["status"] != "ok":
+        await ws.send_json({"type": "error", "error": f"Server {startup['status']}"})
+        await ws.close(code=1013)
+        return 1013
+    stream = StreamingTranscriber(whisper_pool)
+    in_flight = None
+
+    try:
+        while True:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                stream.feed(message["bytes"])
+            elif message.get("text") == "end":
+                break
+            elif message.get("text"):
+                if stream.samples:
+                    raise UnsupportedAudio("stream config must precede audio")
+                try:
+                    config = json.loads(message["text"])
+                    sample_rate = int(config.get("sample_rate", WHISPER_SAMPLE_RATE))
+                    channels = int(config.get("channels", 1))
+                except (ValueError, TypeError, AttributeError) as e:
+                    raise UnsupportedAudio(f"bad stream config: {e}") from None
+                if sample_rate <= 0 or channels <= 0:
+                    raise UnsupportedAudio(f"bad stream config: {sample_rate} Hz, {channels} channels")
+                stream = StreamingTranscriber(whisper_pool, sample_rate, channels)
+
+            if in_flight is not None and in_flight.done():
+                await ws.send_json({"type": "partial", "transcription": in_flight.result()})
+                in_flight = None
+            if in_flight is None and stream.pending_s() >= STREAM_STEP_S:
+                try:
+                    in_flight = asyncio.wrap_future(inference.submit(stream.transcribe))
+                except Overloaded:
+                    pass  # skip this partial pass; the final one catches up
+
+        t0 = time.time()
+        if in_flight is not None:
+            await in_flight
+        # What is left is the open window: at most STREAM_MAX_WINDOW_S plus
+        # the audio that arrived since the last pass
+        transcript = stream.text()
+        if stream.pending_s() > 0:
+            transcript = await inference.run(stream.transcribe)
         transcription_time_ms = (time.time() - t0) * 1000
+        if DEBUG_RECORDING_PATH:
+            write_wav(DEBUG_RECORDING_PATH, stream.pcm())
 
         if not transcript.strip():
-            return JSONResponse({
+            body = {
                 "transcription": "",
                 "function_calls": [],
                 "source": "none",
@@ -165,14 +969,18 @@ def transcribe_and_act(audio: UploadFile = File(...)):
                 "transcription_time_ms": transcription_time_ms,
                 "routing_time_ms": 0,
                 "error": "Empty transcription"
-            })
+            }
+            metrics.observe("transcribe_stream", body)
+            await ws.send_json({"type": "result", **body})
+            await ws.close()
+            return 1000
 
         t1 = time.time()
         messages = [{"role": "user", "content": transcript}]
-        result = generate_hybrid(messages, TOOLS)
+        result = await inference.run(generate_hybrid, messages, TOOLS)
         routing_time_ms = (time.time() - t1) * 1000
 
-        return JSONResponse({
+        body = {
             "transcription": transcript,
             "function_calls": result.get("function_calls", []),
             "source": result.get("source", "unknown"),
@@ -180,23 +988,125 @@ def transcribe_and_act(audio: UploadFile = File(...)):
             "total_time_ms": transcription_time_ms + routing_time_ms,
             "transcription_time_ms": transcription_time_ms,
             "routing_time_ms": routing_time_ms,
-        })
+            "audio_ms": stream.samples * 1000 / WHISPER_SAMPLE_RATE,
+            "transcription_passes": stream.passes,
+        }
+        metrics.observe("transcribe_stream", body)
+        await ws.send_json({"type": "result", **body})
+        await ws.close()
+        return 1000
+
+    except WebSocketDisconnect:
+        return 1001
+
+    except (Overloaded, PoolTimeout, DeadlineExceeded) as e:
+        await ws.send_json({"type": "error", "error": f"Server busy: {e}"})
+        await ws.close(code=1013)
+        return 1013
+
+    except UnsupportedAudio as e:
+        await ws.send_json({"type": "error", "error": f"Bad stream: {e}"})
+        await ws.close(code=1003)
+        return 1003
 
     except Exception as e:
         import traceback
         traceback.print_exc()
+        await ws.send_json({"type": "error", "error": f"{type(e).__name__}: {e}"})
+        await ws.close(code=1011)
+        return 1011
+
+    finally:
+        if in_flight is not None and not in_flight.done():
+            in_flight.cancel()
+
+
+class RouteItem(BaseModel):
+    query: str
+    tools: Optional[List[dict]] = None
+
+
+class RouteRequest(BaseModel):
+    items: List[RouteItem]
+    tools: Optional[List[dict]] = None  # default for items without their own
+
+
+def route_item(item, default_tools, batch_start):
+    """Route one text query; errors are reported per item."""
+    start = time.time()
+    body = {"query": item.query, "wait_ms": (start - batch_start) * 1000}
+    try:
+        messages = [{"role": "user", "content": item.query}]
+        result = generate_hybrid(messages, item.tools or default_tools)
+        body.update({
+            "function_calls": result.get("function_calls", []),
+            "source": result.get("source", "unknown"),
+            "confidence": result.get("confidence", 0),
+            "routing_time_ms": (time.time() - start) * 1000,
+            "stage_timings_ms": result.get("stage_timings_ms", {}),
+        })
+    except Exception as e:
+        body["error"] = f"{type(e).__name__}: {e}"
+    return body
+
+
+def route_batch(request):
+    """Blocking: route every item concurrently on the model pool and return
+    the results in request order."""
+    start = time.time()
+    default_tools = request.tools or TOOLS
+    results = list(route_executor.map(lambda item: route_item(item, default_tools, start), request.items))
+    for body in results:
+        if "error" not in body:
+            metrics.observe("route", body)
+    return {"results": results, "total_time_ms": (time.time() - start) * 1000}
+
+
+@app.post("/route")
+async def route(request: RouteRequest):
+    """Text-in routing for non-voice clients and transcript replays: skips
+    Whisper and runs the batch through generate_hybrid."""
+    with metrics.track():
+        response = await _route(request)
+    metrics.response("route", response.status_code)
+    return response
+
+
+async def _route(request):
+    if startup["status"] != "ok":
+        return not_ready()
+    if len(request.items) > ROUTE_MAX_BATCH:
         return JSONResponse(
-            {"error": f"{type(e).__name__}: {e}"},
-            status_code=500,
+            {"error": f"Batch of {len(request.items)} exceeds {ROUTE_MAX_BATCH} items"},
+            status_code=413,
         )
+    # The whole batch is one executor job, with a deadline scaled to the
+    # number of rounds the model pool needs
+    rounds = math.ceil(len(request.items) / max(1, MODEL_POOL_SIZE)) or 1
+    try:
+        return JSONResponse(await inference.run(route_batch, request, timeout=REQUEST_DEADLINE_S * rounds))
 
-    finally:
-        base = tmp_path.replace(".wav", "")
-        for p in [tmp_path, af_path, base + "_clean.wav"]:
-            if os.path.exists(p):
-                os.unlink(p)
+    except Overloaded as e:
+        return busy(e)
+
+    except DeadlineExceeded as e:
+        return JSONResponse(
+            {"error": f"Deadline exceeded: {e}"},
+            status_code=504,
+        )
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    body = {
+        "status": startup["status"],
+        "startup": startup,
+        "whisper_pool": whisper_pool.stats() if whisper_pool is not None else None,
+        "inference_queue": inference.stats() if inference is not None else None,
+    }
+    return JSONResponse(body, status_code=200 if startup["status"] == "ok" else 503)
@@ -3,8 +3,9 @@ import sys, os
 sys.path.insert(0, "cactus/python/src")
 os.environ["CACTUS_NO_CLOUD_TELE"] = "1"
 
-import json
-from main import generate_hybrid
+import argparse, csv, fnmatch, json, subprocess, time
+import main
+from main import generate_hybrid, prefix_cache_stats
 
 
 ############## Tool definitions ##############
@@ -395,28 +396,145 @@ def compute_f1(predicted_calls, expected_calls):
     return 2 * precision * recall / (precision + recall)
 
 
-def run_benchmark(benchmarks=None):
-    """Run all benchmark cases and print results."""
+def select_cases(benchmarks, names=None, difficulties=None):
+    """Filter cases by name (exact or glob pattern) and by difficulty."""
+    selected = []
+    for case in benchmarks:
+        if names and not any(fnmatch.fnmatchcase(case["name"], pattern) for pattern in names):
+            continue
+        if difficulties and case["difficulty"] not in difficulties:
+            continue
+        selected.append(case)
+    return selected
+
+
+def percentile(values, p):
+    """Linear-interpolated percentile of `values`, p in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def latency_summary(results):
+    """p50/p90/p99/mean of total_time_ms per difficulty, per source and overall."""
+    groups = {}
+    for r in results:
+        for key in (r["difficulty"], f"source:{r['source']}", "overall"):
+            groups.setdefault(key, []).append(r["total_time_ms"])
+    order = [d for d in ("easy", "medium", "hard") if d in groups]
+    order += sorted(k for k in groups if k.startswith("source:")) + ["overall"]
+    return {
+        key: {
+            "n": len(groups[key]),
+            "p50": percentile(groups[key], 50),
+            "p90": percentile(groups[key], 90),
+            "p99": percentile(groups[key], 99),
+            "mean": sum(groups[key]) / len(groups[key]),
+        }
+        for key in order if key in groups
+    }
+
+
+def _result_tool(r):
+    """Grouping key for per-tool tables: the expected tool, or "(multi-intent)"."""
+    names = {c["name"] for c in r["expected"]}
+    return names.pop() if len(names) == 1 else "(multi-intent)"
+
+
+def runtime_summary(results, key):
+    """Average Cactus runtime metrics per group, where `key(result)` names the group."""
+    groups = {}
+    for r in results:
+        groups.setdefault(key(r), []).append(r)
+    table = {}
+    for name, group in groups.items():
+        metrics = [r.get("runtime_metrics") or {} for r in group]
+        n = len(group)
+        table[name] = {
+            "n": n,
+            "model_calls": sum(m.get("model_calls", 0) for m in metrics) / n,
+            "prefill_tokens": sum(m.get("prefill_tokens", 0) for m in metrics) / n,
+            "decode_tokens": sum(m.get("decode_tokens", 0) for m in metrics) / n,
+            "ttft_ms": sum(m.get("time_to_first_token_ms", 0) for m in metrics) / n,
+            "prefill_tps": sum(m.get("prefill_tps", 0) for m in metrics) / n,
+            "decode_tps": sum(m.get("decode_tps", 0) for m in metrics) / n,
+            "time_ms": sum(r["total_time_ms"] for r in group) / n,
+            "ram_mb": max(m.get("ram_usage_mb", 0) for m in metrics),
+        }
+    return table
+
+
+def _print_runtime_table(title, table):
+    print(f"\n--- Runtime metrics by {title} (averages per query) ---")
+    print(f"  {title.capitalize():<20} {'n':>3} {'calls':>5} {'prefill':>8} {'decode':>7} {'TTFT ms':>8} "
+          f"{'pre tok/s':>9} {'dec tok/s':>9} {'time ms':>8} {'RAM MB':>7}")
+    for name, row in table.items():
+        print(f"  {name:<20} {row['n']:>3} {row['model_calls']:>5.1f} {row['prefill_tokens']:>8.1f} "
+              f"{row['decode_tokens']:>7.1f} {row['ttft_ms']:>8.1f} {row['prefill_tps']:>9.1f} "
+              f"{row['decode_tps']:>9.1f} {row['time_ms']:>8.1f} {row['ram_mb']:>7.1f}")
+
+
+def export_results(results, path, summary=None):
+    """Write results to `path` as CSV (one row per run) or JSON (results plus
+    summary), chosen by file extension."""
+    if path.endswith(".csv"):
+        fields = ["name", "difficulty", "run", "total_time_ms", "f1", "source", *main.RUNTIME_METRIC_KEYS]
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            writer.writeheader()
+            for r in results:
+                writer.writerow({**r.get("runtime_metrics", {}), **r})
+        return
+    with open(path, "w") as f:
+        json.dump({"summary": summary or {}, "results": results}, f, indent=2)
+
+
+def run_benchmark(benchmarks=None, warmup=0, repeat=1, names=None, difficulties=None, output=None):
+    """Run benchmark cases and print results.
+
+    Each selected case is first run `warmup` times unrecorded, then `repeat`
+    times recorded. `names` (glob patterns) and `difficulties` filter the
+    cases; `output` exports the recorded runs to a .json or .csv file.
+    """
     if benchmarks is None:
         benchmarks = BENCHMARKS
+    benchmarks = select_cases(benchmarks, names, difficulties)
+    if not benchmarks:
+        print("No benchmark cases selected.")
+        return []
+
+    for w in range(warmup):
+        print(f"[warm-up {w + 1}/{warmup}] running {len(benchmarks)} cases...", flush=True)
+        for case in benchmarks:
+            generate_hybrid(case["messages"], case["tools"])
 
-    total = len(benchmarks)
+    total = len(benchmarks) * repeat
     results = []
-    for i, case in enumerate(benchmarks, 1):
-        print(f"[{i}/{total}] Running: {case['name']} ({case['difficulty']})...", end=" ", flush=True)
-        result = generate_hybrid(case["messages"], case["tools"])
-        f1 = compute_f1(result["function_calls"], case["expected_calls"])
-        source = result.get("source", "unknown")
-        print(f"F1={f1:.2f} | {result['total_time_ms']:.0f}ms | {source}")
-        results.append({
-            "name": case["name"],
-            "difficulty": case["difficulty"],
-            "total_time_ms": result["total_time_ms"],
-            "f1": f1,
-            "source": source,
-            "predicted": result["function_calls"],
-            "expected": case["expected_calls"],
-        })
+    prefix_before = prefix_cache_stats()
+    i = 0
+    for run in range(repeat):
+        for case in benchmarks:
+            i += 1
+            print(f"[{i}/{total}] Running: {case['name']} ({case['difficulty']})...", end=" ", flush=True)
+            result = generate_hybrid(case["messages"], case["tools"])
+            f1 = compute_f1(result["function_calls"], case["expected_calls"])
+            source = result.get("source", "unknown")
+            print(f"F1={f1:.2f} | {result['total_time_ms']:.0f}ms | {source}")
+            results.append({
+                "name": case["name"],
+                "difficulty": case["difficulty"],
+                "run": run,
+                "total_time_ms": result["total_time_ms"],
+                "f1": f1,
+                "source": source,
+                "predicted": result["function_calls"],
+                "expected": case["expected_calls"],
+                "runtime_metrics": result.get("runtime_metrics", {}),
+            })
 
     print("\n=== Benchmark Results ===\n")
     print(f"  {'#':>2} | {'Difficulty':<10} | {'Name':<28} | {'Time (ms)':>10} | {'F1':>5} | Source")
@@ -443,12 +561,43 @@ def run_benchmark(benchmarks=None):
     print(f"  {'overall':<8} avg F1={avg_f1:.2f}  avg time={avg_time:.2f}ms  total time={total_time:.2f}ms")
     print(f"           on-device={on_device_total}/{len(results)} ({100*on_device_total/len(results):.0f}%)  cloud={cloud_total}/{len(results)} ({100*cloud_total/len(results):.0f}%)")
 
+    if main.PREFIX_CACHE:
+        prefix_after = prefix_cache_stats()
+        reuses = prefix_after["reuses"] - prefix_before["reuses"]
+        resets = prefix_after["resets"] - prefix_before["resets"]
+        unconfirmed = prefix_after["unconfirmed"] - prefix_before["unconfirmed"]
+        saved = prefix_after["prefill_tokens_saved"] - prefix_before["prefill_tokens_saved"]
+        print(f"  prefix cache: reused={reuses} (unconfirmed={unconfirmed}) full prefills={resets} prefill tokens saved={saved}")
+
+    latency = latency_summary(results)
+    print("\n--- Latency (ms) ---")
+    print(f"  {'Group':<28} {'n':>4} {'p50':>9} {'p90':>9} {'p99':>9} {'mean':>9}")
+    for key, row in latency.items():
+        print(f"  {key:<28} {row['n']:>4} {row['p50']:>9.2f} {row['p90']:>9.2f} {row['p99']:>9.2f} {row['mean']:>9.2f}")
+
+    by_difficulty = runtime_summary(results, lambda r: r["difficulty"])
+    by_tool = runtime_summary(results, _result_tool)
+    _print_runtime_table("difficulty", by_difficulty)
+    _print_runtime_table("tool", dict(sorted(by_tool.items())))
+
     # Total score
     score = compute_total_score(results)
     print(f"\n{'='*50}")
     print(f"  TOTAL SCORE: {score:.1f}%")
     print(f"{'='*50}")
 
+    if output:
+        export_results(results, output, {
+            "timestamp": time.time(),
+            "warmup": warmup,
+            "repeat": repeat,
+            "total_score": score,
+            "latency_ms": latency,
+            "runtime_by_difficulty": by_difficulty,
+            "runtime_by_tool": by_tool,
+        })
+        print(f"Results written to {output}")
+
     return results
 
 
@@ -487,5 +636,142 @@ def compute_total_score(results):
     return total_score * 100
 
 
+############## Schema comparison ##############
+
+def schema_tokens(benchmarks):
+    """Average estimated tokens of the tool block FunctionGemma sees per case,
+    under the current schema mode."""
+    return sum(main._approx_tokens(main.compile_tools(c["tools"]).cactus_tools) for c in benchmarks) / len(benchmarks)
+
+
+def compare_schemas(**kwargs):
+    """Run the benchmark with full and then compact tool schemas and compare
+    F1, latency and the runtime's prefill tokens. Takes run_benchmark's
+    arguments; returns {mode: summary}."""
+    cases = select_cases(BENCHMARKS, kwargs.get("names"), kwargs.get("difficulties"))
+    if not cases:
+        print("No benchmark cases selected.")
+        return {}
+    previous = main.COMPACT_SCHEMA
+    summaries = {}
+    try:
+        for mode, compact in (("full", False), ("compact", True)):
+            main.set_compact_schema(compact)
+            print(f"\n##### {mode} tool schemas #####")
+            output = kwargs.get("output")
+            if output:
+                root, ext = os.path.splitext(output)
+                output = f"{root}.{mode}{ext}"
+            results = run_benchmark(**{**kwargs, "output": output})
+            metrics = [r.get("runtime_metrics") or {} for r in results]
+            times = [r["total_time_ms"] for r in results]
+            summaries[mode] = {
+                "f1": sum(r["f1"] for r in results) / len(results),
+                "p50_ms": percentile(times, 50),
+                "p90_ms": percentile(times, 90),
+                "mean_ms": sum(times) / len(times),
+                "prefill_tokens": sum(m.get("prefill_tokens", 0) for m in metrics) / len(results),
+                "schema_tokens": schema_tokens(cases),
+                "on_device": sum(r["source"] == "on-device" for r in results) / len(results),
+                "score": compute_total_score(results),
+            }
+    finally:
+        main.set_compact_schema(previous)
+
+    print("\n=== Full vs compact tool schemas (per query) ===")
+    print(f"  {'Schema':<8} {'F1':>5} {'p50 ms':>8} {'p90 ms':>8} {'mean ms':>8} {'prefill':>8} "
+          f"{'schema tok':>10} {'on-device':>9} {'score':>6}")
+    for mode, row in summaries.items():
+        print(f"  {mode:<8} {row['f1']:>5.2f} {row['p50_ms']:>8.1f} {row['p90_ms']:>8.1f} {row['mean_ms']:>8.1f} "
+              f"{row['prefill_tokens']:>8.1f} {row['schema_tokens']:>10.1f} {row['on_device']:>9.0%} {row['score']:>6.1f}")
+    return summaries
+
+
+############## Import-time profile ##############
+
+# Imports main defers until first use: (label, loader in main)
+DEFERRED_IMPORTS = [("cactus", "_cactus"), ("google.genai", "_genai_sdk"), ("numpy", "_numpy")]
+
+
+def _run_python(code, *flags):
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+
+def _parse_importtime(stderr):
+    """[(module, self_us, cumulative_us, depth)] from `python -X importtime`."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def import_profile(runs=5, top=12):
+    """Time `import main` in fresh interpreters (best of `runs`), list the
+    slowest modules it pulls in, and time each deferred import separately."""
+    best = None
+    for _ in range(runs):
+        rows = _parse_importtime(_run_python("import main", "-X", "importtime").stderr)
+        total = next((cum for name, _, cum, _ in rows if name == "main"), None)
+        if total is not None and (best is None or total < best[0]):
+            best = (total, rows)
+    if best is None:
+        print("  import main failed")
+        return None
+
+    total_us, rows = best
+    # importtime lists a module's imports just before it, indented
+    end = next(i for i, r in enumerate(rows) if r[0] == "main" and r[3] == 0)
+    start = end
+    while start > 0 and rows[start - 1][3] > 0:
+        start -= 1
+    print(f"\n=== Import profile (best of {runs}) ===")
+    print(f"  import main: {total_us / 1000:.1f}ms")
+    print(f"  {'module':<40} {'self ms':>8} {'cumul ms':>9}")
+    for name, self_us, cumulative_us, depth in sorted(rows[start:end + 1], key=lambda r: -r[1])[:top]:
+        print(f"  {name:<40} {self_us / 1000:>8.1f} {cumulative_us / 1000:>9.1f}")
+
+    deferred = {}
+    for label, loader in DEFERRED_IMPORTS:
+        code = (
+            "import time, main\n"
+            "start = time.perf_counter()\n"
+            f"main.{loader}()\n"
+            "print((time.perf_counter() - start) * 1000)"
+        )
+        proc = _run_python(code)
+        deferred[label] = float(proc.stdout.strip()) if proc.returncode == 0 else None
+        cost = f"{deferred[label]:.1f}ms" if deferred[label] is not None else "not installed"
+        print(f"  {label + ' (deferred)':<40} {cost:>18}")
+    return {"import_main_ms": total_us / 1000, "deferred_ms": deferred}
+
+
 if __name__ == "__main__":
-    run_benchmark()
+    parser = argparse.ArgumentParser(description="Run the hybrid routing benchmark.")
+    parser.add_argument("--warmup", type=int, default=0, help="unrecorded passes over the cases first")
+    parser.add_argument("--repeat", type=int, default=1, help="recorded passes over the cases")
+    parser.add_argument("--name", action="append", help="case name or glob pattern (repeatable)")
+    parser.add_argument("--difficulty", action="append", choices=["easy", "medium", "hard"], help="repeatable")
+    parser.add_argument("--output", help="export runs to a .json or .csv file")
+    parser.add_argument("--import-profile", action="store_true", help="report import time of main.py and exit")
+    parser.add_argument("--compare-schemas", action="store_true", help="run with full and compact tool schemas")
+    args = parser.parse_args()
+    if args.import_profile:
+        import_profile()
+        sys.exit(0)
+    if args.compare_schemas:
+        compare_schemas(
+            warmup=args.warmup, repeat=args.repeat,
+            names=args.name, difficulties=args.difficulty, output=args.output,
+        )
+        sys.exit(0)
+    run_benchmark(
+        warmup=args.warmup, repeat=args.repeat,
+        names=args.name, difficulties=args.difficulty, output=args.output,
+    )
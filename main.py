@@ -3,10 +3,56 @@ import sys
 sys.path.insert(0, "cactus/python/src")
 functiongemma_path = "cactus/weights/functiongemma-270m-it"
 
-import json, os, time, re
-from cactus import cactus_init, cactus_complete, cactus_destroy, cactus_reset
-from google import genai
-from google.genai import types
+import json, os, time, re, hashlib, threading, queue, random, ctypes, atexit, math, copy, logging, tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import ExitStack, contextmanager
+
+logger = logging.getLogger(__name__)
+
+# The routing helpers (decomposition, repair, slot filling, validation) are
+# pure Python. Cactus, the Gemini SDK and NumPy (semantic cache only) are
+# imported on first use, so tools and on-device-only processes never pay for
+# the runtime they do not touch.
+_cactus_mod = None
+_genai = _genai_types = None
+np = None
+_import_lock = threading.Lock()
+
+
+def _cactus():
+    """The cactus module, imported on first use."""
+    global _cactus_mod
+    if _cactus_mod is None:
+        with _import_lock:
+            if _cactus_mod is None:
+                import cactus
+                _cactus_mod = cactus
+    return _cactus_mod
+
+
+def _genai_sdk():
+    """(google.genai, google.genai.types), imported on first use."""
+    global _genai, _genai_types
+    if _genai is None:
+        with _import_lock:
+            if _genai is None:
+                from google import genai
+                from google.genai import types
+                _genai_types, _genai = types, genai
+    return _genai, _genai_types
+
+
+def _numpy():
+    """The numpy module, imported on first use (sets the module-level `np`)."""
+    global np
+    if np is None:
+        with _import_lock:
+            if np is None:
+                import numpy
+                np = numpy
+    return np
+
 
 DESCRIPTION_OVERRIDES = {
     "set_timer": "Set a countdown timer for a duration in minutes. NOT an alarm.",
@@ -14,15 +60,360 @@ DESCRIPTION_OVERRIDES = {
     "create_reminder": "Create a reminder with a title and time.",
 }
 
+SYSTEM_PROMPT = "You are a model that can do function calling with the following functions"
+TOOLSET_CACHE_SIZE = 128  # with TOOL_PRUNING each pruned subset takes an entry too
+
+# Compact tool schemas for FunctionGemma: first-sentence descriptions without
+# example lists, no `type: object` wrapper, and parameter descriptions trimmed
+# until each tool fits COMPACT_TOKEN_BUDGET (estimated) tokens. Gemini keeps
+# the full schema.
+COMPACT_SCHEMA = os.environ.get("HYBRID_COMPACT_SCHEMA", "0") == "1"
+COMPACT_TOKEN_BUDGET = int(os.environ.get("HYBRID_COMPACT_TOKEN_BUDGET", "48"))
+
+# Opt-in parallel execution of decomposed sub-queries. Each worker borrows its
+# own FunctionGemma handle, so MODEL_POOL_SIZE bounds concurrent inference.
+PARALLEL_SUBQUERIES = os.environ.get("HYBRID_PARALLEL", "0") == "1"
+MODEL_POOL_SIZE = int(os.environ.get("CACTUS_MODEL_POOL_SIZE", "1"))
+
+# Hedged cloud requests: start Gemini while FunctionGemma is still running,
+# after HEDGE_DELAY_MS or immediately for risky queries, and keep whichever
+# validated answer arrives first.
+HEDGE_CLOUD = os.environ.get("HYBRID_HEDGE", "0") == "1"
+HEDGE_DELAY_MS = float(os.environ.get("HYBRID_HEDGE_DELAY_MS", "150"))
+HEDGE_RISK_WORDS = 12
+HEDGE_RISK_REJECTION_RATE = 0.3  # validation rejections of the query's likely tool
+HEDGE_RISK_MIN_PROPOSALS = 5
+
+# Intent-only decoding: stop FunctionGemma as soon as it has named a tool whose
+# arguments _fix_arguments_from_query rebuilds anyway. Unknown tools decode fully.
+INTENT_ONLY_DECODING = os.environ.get("HYBRID_INTENT_ONLY", "0") == "1"
+_CALL_NAME_RE = re.compile(r'call:\s*([A-Za-z_][\w.\-]*)\s*\{|"name"\s*:\s*"([^"]+)"')
+
+# Prefix-cached sessions: skip cactus_reset while a handle's KV cache already
+# holds the system prompt and tool block for the same tool set, so the runtime
+# only prefills the new user turn on top of the shared prefix.
+PREFIX_CACHE = os.environ.get("HYBRID_PREFIX_CACHE", "0") == "1"
+PREFIX_CONFIRM_RATIO = 0.8  # share of the prefix a reused prefill must skip to count
+
+# Tool pruning: show FunctionGemma only the TOOL_PRUNING_TOP_K tools an
+# inverted index over names, descriptions, parameters and aliases ranks
+# highest for the (sub-)query. Queries matching nothing, and pruned attempts
+# that produce no valid call, fall back to the full tool set. Each subset is
+# its own tool block, so with PREFIX_CACHE a handle only reuses its prefix when
+# the next query on it selects the same subset.
+TOOL_PRUNING = os.environ.get("HYBRID_TOOL_PRUNING", "0") == "1"
+TOOL_PRUNING_TOP_K = int(os.environ.get("HYBRID_TOOL_TOP_K", "3"))
+
+# Words users say for a tool that its schema may not contain, keyed on a word
+# that does appear in the tool's name or description.
+TOOL_ALIASES = {
+    "weather": ("forecast", "temperature", "rain", "sunny", "cold", "hot"),
+    "alarm": ("wake",),
+    "timer": ("countdown",),
+    "message": ("text", "tell", "send", "say"),
+    "music": ("play", "song", "listen"),
+    "reminder": ("remind", "remember"),
+    "contacts": ("find", "look", "search", "lookup"),
+    "application": ("open", "launch", "switch", "app"),
+    "shortcut": ("press", "hit", "keys"),
+    "type": ("enter", "write", "dictate"),
+    "click": ("tap", "press", "button"),
+}
+
+# Single-flight: concurrent generate_hybrid (or generate_cloud) calls for the
+# same query text and tool set share one computation; each caller gets
+# its own copy of the result.
+SINGLE_FLIGHT = os.environ.get("HYBRID_SINGLE_FLIGHT", "0") == "1"
+
+# Result cache keyed on normalized query text + tool-set fingerprint.
+# HYBRID_RESULT_CACHE_PATH keeps entries on disk across restarts.
+RESULT_CACHE = os.environ.get("HYBRID_RESULT_CACHE", "0") == "1"
+RESULT_CACHE_SIZE = int(os.environ.get("HYBRID_RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL_S = float(os.environ.get("HYBRID_RESULT_CACHE_TTL_S", "3600"))
+RESULT_CACHE_PATH = os.environ.get("HYBRID_RESULT_CACHE_PATH")
+
+# Semantic intent cache: embed each routed query with cactus_embed and reuse the
+# function name of a near-duplicate (cosine >= SEMANTIC_CACHE_THRESHOLD), running
+# only the slot fillers on the new text. Requires NumPy.
+SEMANTIC_CACHE = os.environ.get("HYBRID_SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_SIZE = int(os.environ.get("HYBRID_SEMANTIC_CACHE_SIZE", "512"))
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("HYBRID_SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_PATH = os.environ.get("HYBRID_SEMANTIC_CACHE_PATH")
+
+# Adaptive routing: decaying failure and latency statistics per likely tool and
+# per query feature. A query whose on-device attempt is expected to cost more
+# than going straight to Gemini skips FunctionGemma; ADAPTIVE_EXPLORE of those
+# still run locally so the statistics can recover. HYBRID_ADAPTIVE=0 (or
+# set_adaptive_routing(False)) is the kill switch.
+ADAPTIVE_ROUTING = os.environ.get("HYBRID_ADAPTIVE", "0") == "1"
+ADAPTIVE_HALF_LIFE = float(os.environ.get("HYBRID_ADAPTIVE_HALF_LIFE", "200"))  # observations
+ADAPTIVE_MIN_WEIGHT = float(os.environ.get("HYBRID_ADAPTIVE_MIN_WEIGHT", "10"))
+ADAPTIVE_EXPLORE = float(os.environ.get("HYBRID_ADAPTIVE_EXPLORE", "0.05"))
+ADAPTIVE_PATH = os.environ.get("HYBRID_ADAPTIVE_PATH")
+
+# Tools with a rule-based slot filler in _fix_arguments_from_query
+SLOT_FILLED_TOOLS = frozenset({
+    "play_music", "set_alarm", "set_timer", "create_reminder",
+    "send_message", "search_contacts", "get_weather",
+})
+
 _model = None
+_embed_model = None
+_embed_lock = threading.Lock()
+_model_pool = queue.LifoQueue()
+_model_pool_lock = threading.Lock()
+_model_pool_count = 0
+_subquery_executor = None
+_hedge_executor = None
+_prefix_by_handle = {}  # id(handle) -> fingerprint of the prefix in its KV cache
+_prefix_disabled = set()  # id(handle) of handles whose reuse the runtime did not confirm
+_prefix_tokens = {}  # fingerprint -> measured prefill tokens of the system + tool prefix
+_prefix_stats = {"reuses": 0, "resets": 0, "unconfirmed": 0, "prefill_tokens_saved": 0}
+_prefix_stats_lock = threading.Lock()
+_pruning_stats = {"pruned": 0, "full": 0, "fallbacks": 0, "tools_offered": 0, "tools_total": 0}
+_pruning_stats_lock = threading.Lock()
 
 def _get_model():
     global _model
     if _model is None:
-        _model = cactus_init(functiongemma_path)
+        _model = _local_backend.init(functiongemma_path)
     return _model
 
 
+def _reset_model_pool(backend):
+    """Destroy every FunctionGemma handle `backend` created, e.g. after
+    switching backends. Idle handles are destroyed now; handles still checked
+    out are destroyed when they come back, and each wakes one caller waiting
+    on the old pool so it retries on the new one."""
+    global _model, _embed_model, _model_pool, _model_pool_count
+    with _model_pool_lock:
+        stale = _model_pool
+        stale.retired_backend = backend
+        _model, _model_pool, _model_pool_count = None, queue.LifoQueue(), 0
+        _prefix_by_handle.clear()
+        _prefix_disabled.clear()
+    with _embed_lock:
+        embed_model, _embed_model = _embed_model, None
+    idle = [embed_model] if embed_model is not None else []
+    while True:
+        try:
+            model = stale.get_nowait()
+        except queue.Empty:
+            break
+        if model is not None:
+            idle.append(model)
+    for model in idle:
+        backend.destroy(model)
+
+
+@contextmanager
+def _checkout_model():
+    """Borrow a FunctionGemma handle for one inference. The first handle is the
+    `_get_model` singleton; more are created on demand up to MODEL_POOL_SIZE,
+    after which callers wait for a handle to be returned."""
+    global _model_pool_count
+    model = None
+    while model is None:  # None: the pool was retired while we waited
+        pool = _model_pool
+        try:
+            model = pool.get_nowait()
+        except queue.Empty:
+            with _model_pool_lock:
+                index = _model_pool_count
+                grow = index < max(1, MODEL_POOL_SIZE)
+                if grow:
+                    _model_pool_count += 1
+            if grow:
+                try:
+                    model = _get_model() if index == 0 else _local_backend.init(functiongemma_path)
+                except Exception:
+                    with _model_pool_lock:
+                        _model_pool_count -= 1
+                    raise
+            else:
+                model = pool.get()
+    try:
+        yield model
+    finally:
+        with _model_pool_lock:
+            retired = pool is not _model_pool
+            pool.put(None if retired else model)
+        if retired:
+            pool.retired_backend.destroy(model)
+
+
+def set_parallel(enabled=True, pool_size=None):
+    """Toggle parallel sub-query execution and optionally resize the model pool.
+    Resizing rebuilds the sub-query and hedge executors; shrinking only takes
+    effect for handles created afterwards."""
+    global PARALLEL_SUBQUERIES, MODEL_POOL_SIZE, _subquery_executor, _hedge_executor
+    PARALLEL_SUBQUERIES = enabled
+    if pool_size is not None and pool_size != MODEL_POOL_SIZE:
+        MODEL_POOL_SIZE = pool_size
+        with _model_pool_lock:
+            executors = (_subquery_executor, _hedge_executor)
+            _subquery_executor = _hedge_executor = None
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+
+def _get_subquery_executor():
+    global _subquery_executor
+    with _model_pool_lock:
+        if _subquery_executor is None:
+            _subquery_executor = ThreadPoolExecutor(
+                max_workers=max(1, MODEL_POOL_SIZE),
+                thread_name_prefix="hybrid-subquery",
+            )
+        return _subquery_executor
+
+
+def preload_models(tools=None):
+    """Create every FunctionGemma handle requests may use and compile `tools`,
+    so the first request pays for neither. The whole pool is loaded even
+    without PARALLEL_SUBQUERIES: concurrent generate_hybrid callers (the
+    bridge's workers, /route) each borrow a handle too. Returns the number
+    of handles in the pool."""
+    wanted = max(1, MODEL_POOL_SIZE)
+    with ExitStack() as stack:
+        for _ in range(wanted):
+            stack.enter_context(_checkout_model())
+    if SEMANTIC_CACHE and PREFIX_CACHE:
+        with _embed_lock:
+            _get_embed_model()
+    if tools:
+        compile_tools(tools)
+    return _model_pool_count
+
+
+class _Cancellation:
+    """Lets a hedging caller stop an in-flight generate_cactus call. The model
+    handle is only bound while its completion runs, so cactus_stop never
+    reaches a handle that has gone back to the pool."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._model = None
+        self._lock = threading.Lock()
+
+    def bind(self, model):
+        with self._lock:
+            self._model = model
+            return not self.cancelled
+
+    def unbind(self):
+        with self._lock:
+            self._model = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._model is not None:
+                _local_backend.stop(self._model)
+
+
+class StageTrace:
+    """Per-stage wall-clock timings (monotonic clock) for one generate_hybrid
+    call. Stages that run several times, or concurrently on worker threads,
+    accumulate into one total per stage."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.runtime = []
+        self._lock = threading.Lock()
+
+    def add(self, name, ms):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + ms
+
+    def add_runtime(self, metrics):
+        with self._lock:
+            self.runtime.append(metrics)
+
+    def runtime_metrics(self):
+        with self._lock:
+            return _sum_runtime_metrics(self.runtime)
+
+    def finish(self):
+        """Stage totals plus "total" wall time and unattributed "overhead"."""
+        total = (time.perf_counter() - self.start) * 1000
+        with self._lock:
+            timings = dict(self.stages)
+        timings["overhead"] = max(0.0, total - sum(timings.values()))
+        timings["total"] = total
+        return timings
+
+
+RUNTIME_METRIC_KEYS = (
+    "time_to_first_token_ms", "prefill_tps", "decode_tps",
+    "prefill_tokens", "decode_tokens", "ram_usage_mb",
+)
+
+
+def _runtime_metrics(raw):
+    """The Cactus performance fields of a cactus_complete response."""
+    return {k: raw.get(k) or 0 for k in RUNTIME_METRIC_KEYS}
+
+
+def _sum_runtime_metrics(metrics):
+    """Combine per-call runtime metrics: tokens and TTFT add up, throughput is
+    recomputed over the combined prefill/decode time, RAM is the peak."""
+    prefill_tokens = sum(m["prefill_tokens"] for m in metrics)
+    decode_tokens = sum(m["decode_tokens"] for m in metrics)
+    prefill_s = sum(m["prefill_tokens"] / m["prefill_tps"] for m in metrics if m["prefill_tps"])
+    decode_s = sum(m["decode_tokens"] / m["decode_tps"] for m in metrics if m["decode_tps"])
+    return {
+        "model_calls": len(metrics),
+        "time_to_first_token_ms": sum(m["time_to_first_token_ms"] for m in metrics),
+        "prefill_tps": prefill_tokens / prefill_s if prefill_s else 0,
+        "decode_tps": decode_tokens / decode_s if decode_s else 0,
+        "prefill_tokens": prefill_tokens,
+        "decode_tokens": decode_tokens,
+        "ram_usage_mb": max((m["ram_usage_mb"] for m in metrics), default=0),
+    }
+
+
+_trace_local = threading.local()
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Install `tracer(stage_timings_ms, result)`, called after every
+    generate_hybrid call; pass None to remove it."""
+    global _tracer
+    _tracer = tracer
+
+
+def _current_trace():
+    return getattr(_trace_local, "trace", None)
+
+
+@contextmanager
+def _stage(name):
+    """Time the enclosed block into the current thread's trace, if any."""
+    trace = getattr(_trace_local, "trace", None)
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, (time.perf_counter() - start) * 1000)
+
+
+def _in_trace(trace, fn, *args):
+    """Run fn(*args) on a worker thread with `trace` as its current trace."""
+    previous = getattr(_trace_local, "trace", None)
+    _trace_local.trace = trace
+    try:
+        return fn(*args)
+    finally:
+        _trace_local.trace = previous
+
+
 def _repair_json(raw_str):
     """Attempt to fix common FunctionGemma JSON issues."""
     if not raw_str:
@@ -192,43 +583,430 @@ def _fix_arguments_from_query(call, query):
     return call
 
 
-def generate_cactus(messages, tools):
-    """Run function calling on-device via FunctionGemma + Cactus."""
-    model = _get_model()
-    cactus_reset(model)
+class CompiledToolset:
+    """A tool list prepared once for Cactus: overrides applied and wrapped in
+    the function envelope, plus the name lookups and index routing needs.
+    Treat instances as read-only, apart from the `subsets` memo."""
+
+    __slots__ = ("fingerprint", "tools", "cactus_tools", "valid_names", "required", "keywords", "index", "subsets")
+    MAX_SUBSETS = 64
+
+    def __init__(self, fingerprint, tools, compact=False):
+        enriched_tools = []
+        for t in tools:
+            if compact:
+                enriched_tools.append(compact_tool(t))
+                continue
+            t_copy = dict(t)
+            if t["name"] in DESCRIPTION_OVERRIDES:
+                t_copy["description"] = DESCRIPTION_OVERRIDES[t["name"]]
+            enriched_tools.append(t_copy)
+
+        self.fingerprint = fingerprint
+        self.tools = tools
+        self.cactus_tools = [{"type": "function", "function": t} for t in enriched_tools]
+        self.valid_names = frozenset(t["name"] for t in tools)
+        self.required = {t["name"]: tuple(t.get("parameters", {}).get("required", [])) for t in tools}
+        # Words of each tool's name and description, for guessing the target tool
+        self.keywords = {
+            t["name"]: frozenset(w for w in _WORD_RE.findall(
+                (t["name"].replace("_", " ") + " " + t.get("description", "")).lower()) if len(w) > 2)
+            for t in tools
+        }
+        self.index = ToolIndex(tools)
+        # Pruned subsets by their tool names, so a repeated selection is the
+        # same list and compile_tools finds it through the identity map
+        self.subsets = {}
+
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_EXAMPLES_RE = re.compile(r"\s*\((?:e\.g\.|eg\.|i\.e\.|such as|like)[^)]*\)", re.IGNORECASE)
+_SENTENCE_END_RE = re.compile(r"(?<=[.;])\s")
+
+
+def _approx_tokens(obj):
+    """Token estimate for a schema as the runtime sees it: ~4 characters of
+    compact JSON per token."""
+    return len(json.dumps(obj, separators=(",", ":"))) // 4
+
+
+def _shorten(text, max_words=None, first_sentence=True):
+    """Drop "(e.g. ...)" lists and, optionally, everything after the first
+    sentence; then cut to `max_words`."""
+    text = _EXAMPLES_RE.sub("", text)
+    if first_sentence:
+        text = _SENTENCE_END_RE.split(text, maxsplit=1)[0]
+    text = text.strip().rstrip(".;")
+    if max_words is not None:
+        text = " ".join(text.split()[:max_words])
+    return text
+
+
+def compact_tool(tool, budget=None):
+    """Compact form of `tool` for FunctionGemma within `budget` estimated
+    tokens (default COMPACT_TOKEN_BUDGET). Names, types and required lists are
+    kept, and so are DESCRIPTION_OVERRIDES, which carry the disambiguation
+    FunctionGemma needs. Other descriptions are trimmed in steps until the
+    tool fits; the last step is returned even if it is still over budget."""
+    budget = COMPACT_TOKEN_BUDGET if budget is None else budget
+    override = DESCRIPTION_OVERRIDES.get(tool["name"])
+    params = tool.get("parameters", {})
+    # (words per parameter description, words of tool description); 0 drops
+    steps = [(None, None), (6, None), (0, None), (0, 10), (0, 6)]
+    for param_words, tool_words in steps:
+        description = override or _shorten(tool.get("description", ""), tool_words)
+        properties = {}
+        for name, spec in params.get("properties", {}).items():
+            prop = {k: v for k, v in spec.items() if k != "description"}
+            text = _shorten(spec.get("description", ""), param_words) if param_words != 0 else ""
+            if text:
+                prop["description"] = text
+            properties[name] = prop
+        compact = {"name": tool["name"], "description": description, "parameters": {"properties": properties}}
+        if params.get("required"):
+            compact["parameters"]["required"] = list(params["required"])
+        if _approx_tokens(compact) <= budget:
+            break
+    return compact
+
+
+def _stem(word):
+    """Crude suffix stripping so "alarms"/"alarm" and "playing"/"play" meet."""
+    if len(word) > 5 and word.endswith("ing"):
+        return word[:-3]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+class ToolIndex:
+    """Inverted index from stemmed terms to the tools they describe. Terms
+    from a tool's name weigh most, then aliases, description, and parameter
+    names and descriptions; each is scaled by inverse document frequency so
+    words every tool shares count for little."""
+
+    FIELD_WEIGHTS = {"name": 3.0, "alias": 2.0, "description": 1.5, "parameter": 1.0}
+
+    def __init__(self, tools):
+        self.names = [t["name"] for t in tools]
+        self.postings = {}  # term -> {tool index: weight}
+        for i, t in enumerate(tools):
+            fields = {
+                "name": t["name"].replace("_", " "),
+                "description": t.get("description", ""),
+                "parameter": " ".join(
+                    f"{k.replace('_', ' ')} {v.get('description', '')}"
+                    for k, v in t.get("parameters", {}).get("properties", {}).items()
+                ),
+            }
+            text_words = set(_WORD_RE.findall((fields["name"] + " " + fields["description"]).lower()))
+            fields["alias"] = " ".join(a for w in text_words for a in TOOL_ALIASES.get(w, ()))
+            for field, text in fields.items():
+                for term in {_stem(w) for w in _WORD_RE.findall(text.lower()) if len(w) > 2}:
+                    weights = self.postings.setdefault(term, {})
+                    weights[i] = max(weights.get(i, 0.0), self.FIELD_WEIGHTS[field])
+        n = len(tools)
+        for weights in self.postings.values():
+            idf = math.log(1 + n / len(weights))
+            for i in weights:
+                weights[i] *= idf
+
+    def scores(self, query):
+        scores = {}
+        for term in {_stem(w) for w in _WORD_RE.findall(query.lower())}:
+            for i, weight in self.postings.get(term, {}).items():
+                scores[i] = scores.get(i, 0.0) + weight
+        return scores
+
+    def top_k(self, query, k):
+        """Indices of the best `k` tools for `query` (ties at the cut kept),
+        or None when no term matches and the full set should be used."""
+        scores = self.scores(query)
+        if not scores:
+            return None
+        ranked = sorted(scores, key=lambda i: (-scores[i], i))
+        cutoff = scores[ranked[min(k, len(ranked)) - 1]]
+        return sorted(i for i in ranked if scores[i] >= cutoff)
+
+
+def _prune_tools(tools, query):
+    """The tools to offer FunctionGemma for `query`, or None to use them all."""
+    if len(tools) <= TOOL_PRUNING_TOP_K:
+        return None
+    compiled = compile_tools(tools)
+    with _stage("tool_pruning"):
+        keep = compiled.index.top_k(query, TOOL_PRUNING_TOP_K)
+    with _pruning_stats_lock:
+        _pruning_stats["tools_total"] += len(tools)
+        if keep is None or len(keep) >= len(tools):
+            _pruning_stats["full"] += 1
+            _pruning_stats["tools_offered"] += len(tools)
+            return None
+        _pruning_stats["pruned"] += 1
+        _pruning_stats["tools_offered"] += len(keep)
+    names = tuple(compiled.index.names[i] for i in keep)
+    subset = compiled.subsets.get(names)
+    if subset is None:
+        subset = [tools[i] for i in keep]
+        if len(compiled.subsets) < CompiledToolset.MAX_SUBSETS:
+            subset = compiled.subsets.setdefault(names, subset)
+    return subset
+
+
+def tool_pruning_stats():
+    """Snapshot of pruned vs full-set attempts, recall fallbacks, and the
+    share of tools actually offered to FunctionGemma."""
+    with _pruning_stats_lock:
+        stats = dict(_pruning_stats)
+    stats["offered_ratio"] = stats["tools_offered"] / stats["tools_total"] if stats["tools_total"] else 1.0
+    return stats
+
+
+_toolset_cache = OrderedDict()
+_toolset_by_id = OrderedDict()  # (id(tools), compact) -> (tools, ids of its items, CompiledToolset)
+_toolset_lock = threading.Lock()
+
+
+def _tools_fingerprint(tools):
+    """Stable content hash of a tool list (key order inside dicts is ignored)."""
+    canonical = json.dumps(tools, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def compile_tools(tools):
+    """Return the CompiledToolset for `tools`, building it on first use.
+    Entries live in a bounded LRU keyed by the tool list fingerprint (marked
+    "+compact" for compact schemas, so the two never share a prefix).
+
+    A request hands the same list object to every stage, so lookups go
+    through an identity map first and only an unseen list (or one whose
+    items were replaced) is hashed. Tool dicts are therefore not re-read:
+    one edited in place after its first use keeps being served in its old
+    form. Pass a new dict (or a new list) to change a tool."""
+    identity_key = (id(tools), COMPACT_SCHEMA)
+    seen = _toolset_by_id.get(identity_key)
+    if seen is not None and seen[0] is tools and seen[1] == tuple(map(id, tools)):
+        with _toolset_lock:
+            if identity_key in _toolset_by_id:
+                _toolset_by_id.move_to_end(identity_key)
+        return seen[2]
+
+    fingerprint = _tools_fingerprint(tools) + ("+compact" if COMPACT_SCHEMA else "")
+    with _toolset_lock:
+        compiled = _toolset_cache.get(fingerprint)
+        if compiled is not None:
+            _toolset_cache.move_to_end(fingerprint)
+    if compiled is None:
+        compiled = CompiledToolset(fingerprint, tools, compact=COMPACT_SCHEMA)
+        with _toolset_lock:
+            _toolset_cache[fingerprint] = compiled
+            _toolset_cache.move_to_end(fingerprint)
+            while len(_toolset_cache) > TOOLSET_CACHE_SIZE:
+                _toolset_cache.popitem(last=False)
+
+    with _toolset_lock:
+        # The entry holds `tools`, so its id cannot be reused while cached
+        _toolset_by_id[identity_key] = (tools, tuple(map(id, tools)), compiled)
+        _toolset_by_id.move_to_end(identity_key)
+        while len(_toolset_by_id) > TOOLSET_CACHE_SIZE:
+            _toolset_by_id.popitem(last=False)
+    return compiled
+
+
+def set_compact_schema(enabled=True):
+    """Switch FunctionGemma between compact and full tool schemas. Both forms
+    stay in the toolset cache under different keys."""
+    global COMPACT_SCHEMA
+    COMPACT_SCHEMA = enabled
+
+
+def _prepare_prefix(model, fingerprint):
+    """Reset `model` unless prefix caching is on and its KV cache already holds
+    this tool set's prefix. Returns True when the prefix is reused. Handles
+    whose reuse the runtime did not confirm are always reset."""
+    enabled = PREFIX_CACHE and id(model) not in _prefix_disabled
+    if enabled and _prefix_by_handle.get(id(model)) == fingerprint:
+        return True
+    _local_backend.reset(model)
+    if enabled:
+        _prefix_by_handle[id(model)] = fingerprint
+    else:
+        _prefix_by_handle.pop(id(model), None)
+    return False
+
+
+def _record_prefill(fingerprint, reused, raw_str, messages):
+    """Track prefill tokens saved by prefix reuse. A full prefill measures the
+    prefix as its prefill tokens minus an estimate of the conversation's. A
+    reuse is credited with that prefix size only if the runtime's prefill came
+    in at least PREFIX_CONFIRM_RATIO of it below a full prefill of the same
+    messages; otherwise, or when there is no measurement to compare with, it
+    is counted as unconfirmed. Returns False for an unconfirmed reuse."""
+    try:
+        prefill_tokens = json.loads(raw_str).get("prefill_tokens")
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        prefill_tokens = None
+    turn_tokens = _approx_tokens(messages)
+    with _prefix_stats_lock:
+        if not reused:
+            _prefix_stats["resets"] += 1
+            if prefill_tokens:
+                _prefix_tokens[fingerprint] = max(0, prefill_tokens - turn_tokens)
+            return True
+        _prefix_stats["reuses"] += 1
+        prefix = _prefix_tokens.get(fingerprint)
+        if prefix and prefill_tokens is not None and (
+                prefix + turn_tokens - prefill_tokens >= PREFIX_CONFIRM_RATIO * prefix):
+            _prefix_stats["prefill_tokens_saved"] += prefix
+            return True
+        _prefix_stats["unconfirmed"] += 1
+        return False
+
+
+def prefix_cache_stats():
+    """Snapshot of prefix-cache reuses, full resets, reuses the runtime's
+    prefill count did not confirm, and prefill tokens saved."""
+    with _prefix_stats_lock:
+        return dict(_prefix_stats)
+
+
+def _record_runtime(raw):
+    """Extract runtime metrics and add them to the current trace, if any."""
+    metrics = _runtime_metrics(raw)
+    trace = _current_trace()
+    if trace is not None:
+        trace.add_runtime(metrics)
+    return metrics
+
+
+def _early_stop_result(name, raw_str, start_time):
+    """Build a generate_cactus result for a completion stopped after the name."""
+    try:
+        raw = json.loads(_repair_json(raw_str))
+    except (json.JSONDecodeError, TypeError):
+        raw = {}
+    calls = [c for c in raw.get("function_calls", []) if c.get("name") == name][:1]
+    if not calls:
+        calls = [{"name": name, "arguments": {}}]
+    calls = _fix_arguments(calls)
+    for call in calls:
+        call["early_stop"] = True
+    return {
+        "function_calls": calls,
+        "total_time_ms": raw.get("total_time_ms") or (time.perf_counter() - start_time) * 1000,
+        "confidence": raw.get("confidence", 0),
+        "runtime_metrics": _record_runtime(raw),
+    }
+
+
+class _IntentWatcher:
+    """Streaming callback that parses the function name as tokens arrive and
+    stops decoding once it names a tool covered by a slot filler."""
+
+    def __init__(self, model, stoppable_names):
+        self.model = model
+        self.stoppable_names = stoppable_names
+        self.text = ""
+        self.name = None
 
-    enriched_tools = []
-    for t in tools:
-        t_copy = dict(t)
-        if t["name"] in DESCRIPTION_OVERRIDES:
-            t_copy["description"] = DESCRIPTION_OVERRIDES[t["name"]]
-        enriched_tools.append(t_copy)
+    def __call__(self, token, token_id, user_data):
+        if self.name is not None:
+            return
+        if isinstance(token, bytes):
+            token = token.decode("utf-8", errors="ignore")
+        self.text += token or ""
+        m = _CALL_NAME_RE.search(self.text)
+        if m:
+            name = m.group(1) or m.group(2)
+            if name in self.stoppable_names:
+                self.name = name
+                _local_backend.stop(self.model)
 
-    cactus_tools = [{
-        "type": "function",
-        "function": t,
-    } for t in enriched_tools]
 
-    raw_str = cactus_complete(
+def _complete(model, messages, compiled, callback=None):
+    """One raw FunctionGemma completion of `messages` against `compiled`."""
+    return _local_backend.complete(
         model,
-        [{"role": "system", "content": "You are a model that can do function calling with the following functions"}] + messages,
-        tools=cactus_tools,
+        [{"role": "system", "content": SYSTEM_PROMPT}] + messages,
+        tools=compiled.cactus_tools,
         force_tools=True,
         max_tokens=256,
         stop_sequences=["<|im_end|>", "<end_of_turn>"],
         confidence_threshold=0.1,
         tool_rag_top_k=0,
+        callback=callback,
     )
 
+
+def warm_up_models(tools, query):
+    """Run one completion of `query` on every pooled FunctionGemma handle so
+    the first requests do not pay for cold weights and kernels. Talks to the
+    backend directly: no cache, statistic or recorder sees the warm-up, and
+    each handle is reset afterwards so no prefix is left behind. Returns the
+    number of handles warmed."""
+    compiled = compile_tools(tools)
+    messages = [{"role": "user", "content": query}]
+    with ExitStack() as stack:
+        models = [stack.enter_context(_checkout_model()) for _ in range(max(1, MODEL_POOL_SIZE))]
+        for model in models:
+            _local_backend.reset(model)
+            try:
+                _complete(model, messages, compiled)
+            finally:
+                _local_backend.reset(model)
+                _prefix_by_handle.pop(id(model), None)
+    return len(models)
+
+
+def generate_cactus(messages, tools, cancel=None, intent_only=None):
+    """Run function calling on-device via FunctionGemma + Cactus.
+    `cancel` is an optional _Cancellation used by the hedged router.
+    `intent_only` (default INTENT_ONLY_DECODING) stops decoding once a
+    slot-filled tool is named; such calls come back with "early_stop" set and
+    whatever arguments had been decoded, usually none."""
+    compiled = compile_tools(tools)
+    if intent_only is None:
+        intent_only = INTENT_ONLY_DECODING
+    watcher = None
+    start_time = time.perf_counter()
+    with _checkout_model() as model:
+        if cancel is not None and not cancel.bind(model):
+            return {"function_calls": [], "total_time_ms": 0, "confidence": 0}
+        stoppable = compiled.valid_names & SLOT_FILLED_TOOLS
+        if intent_only and stoppable:
+            watcher = _IntentWatcher(model, stoppable)
+        try:
+            reused = _prepare_prefix(model, compiled.fingerprint)
+
+            with _stage("model_call"):
+                raw_str = _complete(model, messages, compiled, callback=watcher)
+        except Exception:
+            _prefix_by_handle.pop(id(model), None)
+            raise
+        finally:
+            if cancel is not None:
+                cancel.unbind()
+        if PREFIX_CACHE and not _record_prefill(compiled.fingerprint, reused, raw_str, messages):
+            # Nothing shows the runtime matched the cached prefix; the KV cache
+            # may hold the conversation twice, so clear it and stop reusing here
+            _local_backend.reset(model)
+            _prefix_by_handle.pop(id(model), None)
+            _prefix_disabled.add(id(model))
+
+    if watcher is not None and watcher.name is not None:
+        return _early_stop_result(watcher.name, raw_str, start_time)
+
     try:
         raw = json.loads(raw_str)
     except json.JSONDecodeError:
         try:
-            raw = json.loads(_repair_json(raw_str))
+            with _stage("json_repair"):
+                raw = json.loads(_repair_json(raw_str))
         except json.JSONDecodeError:
+            # The runtime's own timing is inside the unparseable payload
             return {
                 "function_calls": [],
-                "total_time_ms": 0,
+                "total_time_ms": (time.perf_counter() - start_time) * 1000,
                 "confidence": 0,
             }
 
@@ -238,46 +1016,115 @@ def generate_cactus(messages, tools):
         "function_calls": calls,
         "total_time_ms": raw.get("total_time_ms", 0),
         "confidence": raw.get("confidence", 0),
+        "runtime_metrics": _record_runtime(raw),
     }
 
 
-def generate_cloud(messages, tools):
-    """Run function calling via Gemini Cloud API."""
-    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-
-    gemini_tools = [
-        types.Tool(function_declarations=[
-            types.FunctionDeclaration(
-                name=t["name"],
-                description=t["description"],
-                parameters=types.Schema(
-                    type="OBJECT",
-                    properties={
-                        k: types.Schema(type=v["type"].upper(), description=v.get("description", ""))
-                        for k, v in t["parameters"]["properties"].items()
-                    },
-                    required=t["parameters"].get("required", []),
-                ),
-            )
-            for t in tools
-        ])
-    ]
-
-    contents = [m["content"] for m in messages if m["role"] == "user"]
+GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_TIMEOUT_MS = int(os.environ.get("GEMINI_TIMEOUT_MS", "15000"))
 
-    start_time = time.time()
 
-    gemini_response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=contents,
-        config=types.GenerateContentConfig(tools=gemini_tools),
-    )
+class GeminiClientManager:
+    """Long-lived Gemini client shared by every cloud call.
 
-    total_time_ms = (time.time() - start_time) * 1000
+    Holds one `genai.Client` (and so one pooled HTTP connection set), caches the
+    built tool declarations and request config per tool-set fingerprint, and
+    applies a request timeout. `base_url` points the client at another endpoint
+    (e.g. a local stub server); `http_options` is passed through to
+    `types.HttpOptions` for anything else, such as a custom HTTP transport.
+    """
 
+    def __init__(self, api_key=None, base_url=None, timeout_ms=None, http_options=None):
+        self.api_key = api_key
+        self.base_url = base_url if base_url is not None else os.environ.get("GEMINI_BASE_URL")
+        self.timeout_ms = timeout_ms if timeout_ms is not None else GEMINI_TIMEOUT_MS
+        self.http_options = dict(http_options or {})
+        self._client = None
+        self._configs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                genai, types = _genai_sdk()
+                options = {"timeout": self.timeout_ms, **self.http_options}
+                if self.base_url:
+                    options["base_url"] = self.base_url
+                self._client = genai.Client(
+                    api_key=self.api_key or os.environ.get("GEMINI_API_KEY"),
+                    http_options=types.HttpOptions(**options),
+                )
+            return self._client
+
+    def config_for(self, tools):
+        """GenerateContentConfig with the Gemini declarations for `tools`."""
+        fingerprint = compile_tools(tools).fingerprint
+        with self._lock:
+            config = self._configs.get(fingerprint)
+            if config is not None:
+                self._configs.move_to_end(fingerprint)
+                return config
+
+        _, types = _genai_sdk()
+        gemini_tools = [
+            types.Tool(function_declarations=[
+                types.FunctionDeclaration(
+                    name=t["name"],
+                    description=t["description"],
+                    parameters=types.Schema(
+                        type="OBJECT",
+                        properties={
+                            k: types.Schema(type=v["type"].upper(), description=v.get("description", ""))
+                            for k, v in t["parameters"]["properties"].items()
+                        },
+                        required=t["parameters"].get("required", []),
+                    ),
+                )
+                for t in tools
+            ])
+        ]
+        config = types.GenerateContentConfig(tools=gemini_tools)
+        with self._lock:
+            self._configs[fingerprint] = config
+            while len(self._configs) > TOOLSET_CACHE_SIZE:
+                self._configs.popitem(last=False)
+        return config
+
+    def close(self):
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None and hasattr(client, "close"):
+            client.close()
+
+
+_cloud_manager = None
+_cloud_manager_lock = threading.Lock()
+
+
+def get_cloud_manager():
+    global _cloud_manager
+    with _cloud_manager_lock:
+        if _cloud_manager is None:
+            _cloud_manager = GeminiClientManager()
+        return _cloud_manager
+
+
+def configure_cloud(**kwargs):
+    """Replace the shared GeminiClientManager, e.g. with a stub `base_url`
+    for tests and benchmarks. Takes GeminiClientManager's arguments."""
+    global _cloud_manager
+    with _cloud_manager_lock:
+        old, _cloud_manager = _cloud_manager, GeminiClientManager(**kwargs)
+    if old is not None:
+        old.close()
+    return _cloud_manager
+
+
+def _parse_cloud_response(gemini_response, total_time_ms):
     function_calls = []
-    for candidate in gemini_response.candidates:
-        for part in candidate.content.parts:
+    for candidate in gemini_response.candidates or []:
+        for part in candidate.content.parts or []:
             if part.function_call:
                 function_calls.append({
                     "name": part.function_call.name,
@@ -290,6 +1137,311 @@ def generate_cloud(messages, tools):
     }
 
 
+############## Inference backends ##############
+#
+# generate_cactus and generate_cloud talk to a backend rather than to Cactus and
+# Gemini directly. A local backend provides init/complete/reset/stop/embed/
+# destroy/transcribe with cactus_* semantics (complete returns the Cactus JSON
+# response string); a cloud backend provides generate/agenerate returning
+# generate_cloud's result dict. FakeBackend implements both.
+
+class CactusBackend:
+    """Local inference through the Cactus runtime."""
+
+    name = "cactus"
+
+    def init(self, model_path):
+        return _cactus().cactus_init(model_path)
+
+    def complete(self, model, messages, **options):
+        return _cactus().cactus_complete(model, messages, **options)
+
+    def reset(self, model):
+        _cactus().cactus_reset(model)
+
+    def stop(self, model):
+        _cactus().cactus_stop(model)
+
+    def embed(self, model, text):
+        return _cactus().cactus_embed(model, text, normalize=True)
+
+    def destroy(self, model):
+        _cactus().cactus_destroy(model)
+
+    def transcribe(self, model, audio_path, prompt, options=None, buffer=None, pcm=None):
+        """Whisper transcription via the C API (the Python wrapper does not
+        take options). `buffer` is an optional reusable ctypes output buffer.
+        `pcm` (16 kHz mono int16 NumPy array) is passed in memory instead of
+        reading `audio_path`."""
+        if buffer is None:
+            buffer = ctypes.create_string_buffer(65536)
+        pcm_ptr, pcm_size = None, 0
+        if pcm is not None:
+            pcm_ptr = pcm.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8))
+            pcm_size = pcm.nbytes
+        cactus = _cactus()
+        cactus._lib.cactus_reset(model)
+        cactus._lib.cactus_transcribe(
+            model,
+            audio_path.encode() if audio_path else None, prompt.encode(),
+            buffer, len(buffer),
+            json.dumps(options or {"use_vad": False}).encode(),
+            cactus.TokenCallback(), None,
+            pcm_ptr, pcm_size,
+        )
+        return buffer.value.decode()
+
+
+class GeminiBackend:
+    """Cloud inference through the shared GeminiClientManager."""
+
+    name = "gemini"
+
+    def generate(self, messages, tools):
+        manager = get_cloud_manager()
+        config = manager.config_for(tools)
+        contents = [m["content"] for m in messages if m["role"] == "user"]
+        start_time = time.perf_counter()
+        gemini_response = manager.client.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=config,
+        )
+        return _parse_cloud_response(gemini_response, (time.perf_counter() - start_time) * 1000)
+
+    async def agenerate(self, messages, tools):
+        manager = get_cloud_manager()
+        config = manager.config_for(tools)
+        contents = [m["content"] for m in messages if m["role"] == "user"]
+        start_time = time.perf_counter()
+        gemini_response = await manager.client.aio.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=config,
+        )
+        return _parse_cloud_response(gemini_response, (time.perf_counter() - start_time) * 1000)
+
+
+class _FakeHandle:
+    def __init__(self, path):
+        self.path = path
+        self.stopped = False
+
+
+class FakeBackend:
+    """Deterministic stand-in for Cactus and Gemini, for load tests without
+    weights or network.
+
+    Outputs come from `script` (a dict of normalized query -> calls, or a
+    callable(query, tools) returning calls or None) and otherwise from rules:
+    the tool whose name and description best overlap the query, with
+    arguments from the slot fillers. Latencies are a fixed ms value, a
+    (mean, stddev) normal, or a callable(rng) -> ms; `failure_rate` makes a
+    local completion come back malformed or a cloud call raise. Randomness is
+    seeded per query, so a run is reproducible regardless of thread timing.
+    """
+
+    name = "fake"
+
+    def __init__(self, script=None, latency_ms=(60, 10), decode_ms_per_token=4,
+                 cloud_latency_ms=(900, 150), failure_rate=0.0, cloud_failure_rate=0.0,
+                 transcripts=None, seed=0, latency_scale=1.0):
+        self.script = script or {}
+        self.latency_ms = latency_ms
+        self.decode_ms_per_token = decode_ms_per_token
+        self.cloud_latency_ms = cloud_latency_ms
+        self.failure_rate = failure_rate
+        self.cloud_failure_rate = cloud_failure_rate
+        self.transcripts = transcripts or ["open Safari"]
+        self.seed = seed
+        self.latency_scale = latency_scale
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _rng(self, kind, text):
+        with self._lock:
+            n = self._counts.get((kind, text), 0)
+            self._counts[(kind, text)] = n + 1
+        return random.Random(f"{self.seed}:{kind}:{text}:{n}")
+
+    def _sleep_ms(self, spec, rng):
+        if callable(spec):
+            ms = spec(rng)
+        elif isinstance(spec, (tuple, list)):
+            ms = rng.gauss(spec[0], spec[1])
+        else:
+            ms = spec
+        ms = max(0.0, ms * self.latency_scale)
+        time.sleep(ms / 1000)
+        return ms
+
+    def calls_for(self, query, tools):
+        """Scripted calls for `query`, else rule-derived ones."""
+        scripted = self.script(query, tools) if callable(self.script) else self.script.get(_normalize_query(query))
+        if scripted is not None:
+            return json.loads(json.dumps(scripted))
+        words = set(re.findall(r"[a-z]+", query.lower()))
+        best, best_score = None, 0
+        for t in tools:
+            name_words = set(t["name"].lower().split("_"))
+            desc_words = {w for w in re.findall(r"[a-z]+", t.get("description", "").lower()) if len(w) > 3}
+            score = 2 * len(words & name_words) + len(words & desc_words)
+            score += sum(1 for w in words for n in name_words if len(n) > 3 and w != n and w.startswith(n))
+            if score > best_score:
+                best, best_score = t, score
+        if best is None:
+            return []
+        call = _fix_arguments_from_query({"name": best["name"], "arguments": {}}, query)
+        rest = query.strip().rstrip("?.!").split(None, 1)
+        for key in best.get("parameters", {}).get("required", []):
+            if key in call["arguments"]:
+                continue
+            if best["parameters"]["properties"].get(key, {}).get("type") == "integer":
+                m = re.search(r"\d+", query)
+                call["arguments"][key] = int(m.group()) if m else 0
+            else:
+                call["arguments"][key] = rest[1] if len(rest) > 1 else query
+        return [call]
+
+    # Local backend interface
+
+    def init(self, model_path):
+        return _FakeHandle(model_path)
+
+    def reset(self, model):
+        model.stopped = False
+
+    def stop(self, model):
+        model.stopped = True
+
+    def destroy(self, model):
+        pass
+
+    def embed(self, model, text):
+        vector = [0.0] * 64
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % 64] += 1.0
+        return vector
+
+    def complete(self, model, messages, tools=None, callback=None, **options):
+        query = messages[-1]["content"] if messages else ""
+        rng = self._rng("local", query)
+        model.stopped = False
+        tool_list = [t.get("function", t) for t in tools or []]
+        prefill_tokens = len(json.dumps(messages)) // 4 + len(json.dumps(tools or [])) // 4
+        start = time.perf_counter()
+        self._sleep_ms(self.latency_ms, rng)
+        ttft_ms = (time.perf_counter() - start) * 1000
+
+        calls = self.calls_for(query, tool_list)
+        failed = rng.random() < self.failure_rate
+        text = "".join(
+            "<start_function_call>call:%s{%s}<end_function_call>" % (
+                c["name"], ",".join(f"{k}:<escape>{v}<escape>" for k, v in c["arguments"].items()))
+            for c in calls
+        )
+        tokens = re.findall(r"<[^>]+>|\w+|[^\w\s]|\s+", text)
+        decoded = 0
+        for token in tokens:
+            if model.stopped:
+                break
+            decoded += 1
+            self._sleep_ms(self.decode_ms_per_token, rng)
+            if callback is not None:
+                callback(token, decoded, None)
+        total_ms = (time.perf_counter() - start) * 1000
+        if failed:
+            return '{"function_calls": [{"name": "%s", "arguments": {"minute":' % (calls[0]["name"] if calls else "")
+        return json.dumps({
+            "success": True,
+            "function_calls": calls if not model.stopped else [],
+            "confidence": round(rng.uniform(0.5, 1.0), 4),
+            "time_to_first_token_ms": ttft_ms,
+            "total_time_ms": total_ms,
+            "prefill_tps": prefill_tokens / (ttft_ms / 1000) if ttft_ms else 0,
+            "decode_tps": decoded / ((total_ms - ttft_ms) / 1000) if total_ms > ttft_ms else 0,
+            "ram_usage_mb": 0,
+            "prefill_tokens": prefill_tokens,
+            "decode_tokens": decoded,
+            "total_tokens": prefill_tokens + decoded,
+        })
+
+    def transcribe(self, model, audio_path, prompt, options=None, buffer=None, pcm=None):
+        rng = self._rng("transcribe", audio_path or str(len(pcm) if pcm is not None else 0))
+        self._sleep_ms(self.latency_ms, rng)
+        transcripts = self.transcripts
+        text = transcripts(audio_path) if callable(transcripts) else rng.choice(transcripts)
+        return json.dumps({"success": True, "response": text})
+
+    # Cloud backend interface
+
+    def generate(self, messages, tools):
+        query = " ".join(m["content"] for m in messages if m["role"] == "user")
+        rng = self._rng("cloud", query)
+        start = time.perf_counter()
+        self._sleep_ms(self.cloud_latency_ms, rng)
+        if rng.random() < self.cloud_failure_rate:
+            raise RuntimeError("FakeBackend: simulated cloud failure")
+        sub_queries = _decompose_query(query) or [query]
+        calls = [c for sq in sub_queries for c in self.calls_for(sq, tools)]
+        return {"function_calls": calls, "total_time_ms": (time.perf_counter() - start) * 1000}
+
+    async def agenerate(self, messages, tools):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, self.generate, messages, tools)
+
+
+def _default_backends():
+    if os.environ.get("HYBRID_BACKEND", "cactus") == "fake":
+        fake = FakeBackend(
+            failure_rate=float(os.environ.get("HYBRID_FAKE_FAILURE_RATE", "0")),
+            cloud_failure_rate=float(os.environ.get("HYBRID_FAKE_CLOUD_FAILURE_RATE", "0")),
+            seed=int(os.environ.get("HYBRID_FAKE_SEED", "0")),
+            latency_scale=float(os.environ.get("HYBRID_FAKE_LATENCY_SCALE", "1")),
+        )
+        return fake, fake
+    return CactusBackend(), GeminiBackend()
+
+
+_local_backend, _cloud_backend = _default_backends()
+
+
+def get_backends():
+    """The (local, cloud) backends currently in use."""
+    return _local_backend, _cloud_backend
+
+
+def set_backends(local=None, cloud=None):
+    """Swap the local and/or cloud backend. Changing the local backend destroys
+    the FunctionGemma handle pool so new handles come from the new backend."""
+    global _local_backend, _cloud_backend
+    if local is not None and local is not _local_backend:
+        previous, _local_backend = _local_backend, local
+        _reset_model_pool(previous)
+    if cloud is not None:
+        _cloud_backend = cloud
+
+
+def generate_cloud(messages, tools):
+    """Run function calling via Gemini Cloud API. With SINGLE_FLIGHT,
+    identical concurrent requests share one Gemini call."""
+    with _stage("cloud_call"):
+        if SINGLE_FLIGHT:
+            key = _flight_key(messages, compile_tools(tools).fingerprint)
+            result = _cloud_flights.do(key, _cloud_backend.generate, messages, tools)
+        else:
+            result = _cloud_backend.generate(messages, tools)
+    if ADAPTIVE_ROUTING:
+        get_adaptive_router().record_cloud(result.get("total_time_ms", 0))
+    return result
+
+
+async def generate_cloud_async(messages, tools):
+    """Async variant of generate_cloud on the shared client's aio interface."""
+    with _stage("cloud_call"):
+        return await _cloud_backend.agenerate(messages, tools)
+
+
 ACTION_VERBS = {"set", "check", "get", "send", "text", "play", "find", "remind",
                 "look", "search", "create", "wake", "tell", "show", "turn", "make",
                 "start", "message", "ask", "add", "cancel", "stop", "open",
@@ -336,6 +1488,906 @@ def _resolve_pronouns(sub_queries):
     return resolved
 
 
+# Rule-based shortcuts for simple keyboard actions (no model call needed)
+KEYBOARD_SHORTCUTS = {
+    "enter": "Return", "press enter": "Return", "hit enter": "Return",
+    "tab": "Tab", "press tab": "Tab",
+    "escape": "Escape", "press escape": "Escape",
+}
+
+
+# Per-tool counts of FunctionGemma calls proposed and rejected by validation.
+# Names outside the tool set are counted under "<unknown>".
+_validation_stats = {}
+_validation_stats_lock = threading.Lock()
+
+
+def _record_validation(name, valid):
+    with _validation_stats_lock:
+        stats = _validation_stats.setdefault(name, {"proposed": 0, "rejected": 0})
+        stats["proposed"] += 1
+        if not valid:
+            stats["rejected"] += 1
+
+
+def validation_stats():
+    """Snapshot of {tool: {"proposed", "rejected"}} for on-device calls."""
+    with _validation_stats_lock:
+        return {name: dict(stats) for name, stats in _validation_stats.items()}
+
+
+def _filter_local_calls(local, query, valid_names, required):
+    """Slot-fill and validate FunctionGemma's calls against `query`. Returns None
+    when an early-stopped call is left without its required arguments."""
+    valid_calls = []
+    for c in local["function_calls"]:
+        if c.get("name") not in valid_names:
+            _record_validation("<unknown>", False)
+            continue
+        early_stop = c.pop("early_stop", False)
+        with _stage("slot_filling"):
+            c = _fix_arguments_from_query(c, query)
+        if early_stop and any(k not in c["arguments"] for k in required.get(c["name"], ())):
+            return None
+        with _stage("validation"):
+            valid = _validate_call(c) and _sanity_check(c, query)
+        _record_validation(c["name"], valid)
+        if valid:
+            valid_calls.append(c)
+    return valid_calls
+
+
+def _local_attempt(messages, tools, query, valid_names, cancel=None):
+    required = compile_tools(tools).required
+    local = generate_cactus(messages, tools, cancel=cancel)
+    valid_calls = _filter_local_calls(local, query, valid_names, required)
+    if valid_calls is None:
+        # Slot filler could not rebuild the arguments; decode them fully
+        retry = generate_cactus(messages, tools, cancel=cancel, intent_only=False)
+        retry["total_time_ms"] = retry.get("total_time_ms", 0) + local.get("total_time_ms", 0)
+        local = retry
+        valid_calls = _filter_local_calls(local, query, valid_names, required)
+    return local, valid_calls
+
+
+def _local_calls(messages, tools, query, valid_names, cancel=None):
+    """Run FunctionGemma and keep only calls that survive slot filling and
+    validation against `query`. With TOOL_PRUNING the model first sees only
+    the top-ranked tools, and the full set if that yields nothing valid."""
+    candidates = _prune_tools(tools, query) if TOOL_PRUNING else None
+    local, valid_calls = _local_attempt(messages, candidates or tools, query, valid_names, cancel)
+    if candidates is not None and not valid_calls and not (cancel is not None and cancel.cancelled):
+        with _pruning_stats_lock:
+            _pruning_stats["fallbacks"] += 1
+        retry, valid_calls = _local_attempt(messages, tools, query, valid_names, cancel)
+        retry["total_time_ms"] = retry.get("total_time_ms", 0) + local.get("total_time_ms", 0)
+        local = retry
+    if ADAPTIVE_ROUTING and not (cancel is not None and cancel.cancelled):
+        get_adaptive_router().record_local(query, compile_tools(tools), not valid_calls, local.get("total_time_ms", 0))
+    return local, valid_calls
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    with _model_pool_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=2 * max(1, MODEL_POOL_SIZE) + 2,
+                thread_name_prefix="hybrid-hedge",
+            )
+        return _hedge_executor
+
+
+def _hedge_is_risky(query, compiled):
+    """Risk signal for launching the cloud request with no delay: the query is
+    long enough to confuse the model, matches no tool in the index, or targets
+    a tool whose on-device calls validation has rejected at least
+    HEDGE_RISK_REJECTION_RATE of the time (over HEDGE_RISK_MIN_PROPOSALS)."""
+    if len(query.split()) > HEDGE_RISK_WORDS:
+        return True
+    likely = compiled.index.top_k(query, 1)
+    if likely is None:
+        return True
+    with _validation_stats_lock:
+        for i in likely:
+            stats = _validation_stats.get(compiled.tools[i]["name"])
+            if (stats and stats["proposed"] >= HEDGE_RISK_MIN_PROPOSALS
+                    and stats["rejected"] >= HEDGE_RISK_REJECTION_RATE * stats["proposed"]):
+                return True
+    return False
+
+
+def _hedged_calls(messages, tools, query, valid_names):
+    """Race FunctionGemma against a delayed Gemini request.
+
+    Returns (calls, time_ms, used_cloud, report). The report records which path
+    won, when the hedge launched, and how much wall time was saved against
+    running the cloud fallback after the on-device attempt. Errors on either
+    side are logged and named in the report ("local_error", "cloud_error");
+    when neither side returns an answer, the error is raised as on the
+    unhedged path.
+    """
+    executor = _get_hedge_executor()
+    cancel = _Cancellation()
+    start = time.perf_counter()
+    trace = _current_trace()
+    local_f = executor.submit(_in_trace, trace, _local_calls, messages, tools, query, valid_names, cancel)
+
+    delay_s = 0 if _hedge_is_risky(query, compile_tools(tools)) else HEDGE_DELAY_MS / 1000
+    wait([local_f], timeout=delay_s)
+
+    cloud_f = None
+    cloud_launch_ms = None
+    local_ms = None
+    winner, calls, time_ms = "none", [], 0
+    last_cloud = cloud_error = local_error = None
+    pending = {local_f}
+
+    def launch_cloud():
+        nonlocal cloud_f, cloud_launch_ms
+        cloud_launch_ms = (time.perf_counter() - start) * 1000
+        cloud_f = executor.submit(_in_trace, trace, generate_cloud, messages, tools)
+        pending.add(cloud_f)
+
+    if not local_f.done():
+        launch_cloud()
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        pending -= done
+        if local_f in done:
+            local_ms = (time.perf_counter() - start) * 1000
+            try:
+                local, valid_calls = local_f.result()
+            except Exception as e:
+                logger.warning("hedged on-device attempt failed: %r", e)
+                local_error = e
+                local, valid_calls = {"total_time_ms": 0}, []
+            if valid_calls:
+                winner, calls, time_ms = "on-device", valid_calls, local.get("total_time_ms", 0)
+                break
+            if cloud_f is None:
+                launch_cloud()
+        if cloud_f is not None and cloud_f in done:
+            try:
+                last_cloud = cloud_f.result()
+            except Exception as e:
+                cloud_error = e
+                continue
+            cloud_calls = [c for c in last_cloud.get("function_calls", []) if c.get("name") in valid_names]
+            if cloud_calls:
+                winner, calls = "cloud", cloud_calls
+                time_ms = cloud_launch_ms + last_cloud.get("total_time_ms", 0)
+                break
+
+    wall_ms = (time.perf_counter() - start) * 1000
+    if winner == "cloud" and local_ms is None:
+        cancel.cancel()
+        local_ms = wall_ms
+    elif winner == "on-device" and cloud_f is not None:
+        cloud_f.cancel()
+    elif winner == "none" and (cloud_error or local_error) is not None and last_cloud is None:
+        # Both sides failed: raise what the unhedged path would have raised first
+        raise local_error or cloud_error
+    elif winner == "none" and last_cloud is not None:
+        # Nobody produced a valid answer; surface the cloud output unfiltered
+        calls = last_cloud.get("function_calls", [])
+        time_ms = wall_ms
+
+    # Sequential routing would have run the cloud call only after the local
+    # attempt finished (or, when it was stopped, at least this long).
+    sequential_ms = local_ms if winner == "on-device" else (local_ms or 0) + (
+        last_cloud.get("total_time_ms", 0) if last_cloud else 0)
+    report = {
+        "winner": winner,
+        "launched": cloud_f is not None,
+        "launch_ms": cloud_launch_ms,
+        "wall_ms": wall_ms,
+        "saved_ms": max(0.0, sequential_ms - wall_ms),
+    }
+    if cloud_error is not None:
+        report["cloud_error"] = repr(cloud_error)
+    if local_error is not None:
+        report["local_error"] = repr(local_error)
+    return calls, time_ms, winner != "on-device", report
+
+
+def _merge_hedge_reports(reports, parallel):
+    """One hedge report for a multi-intent query. Wall and sequential times
+    add up across sub-queries, or take the slowest when they ran in parallel;
+    "sub_queries" keeps the individual reports."""
+    combine = max if parallel else sum
+    wall_ms = combine(r["wall_ms"] for r in reports)
+    sequential_ms = combine(r["wall_ms"] + r["saved_ms"] for r in reports)
+    winners = {r["winner"] for r in reports}
+    return {
+        "winner": winners.pop() if len(winners) == 1 else "mixed",
+        "launched": any(r["launched"] for r in reports),
+        "wall_ms": wall_ms,
+        "saved_ms": max(0.0, sequential_ms - wall_ms),
+        "sub_queries": reports,
+    }
+
+
+def _route_subquery(sq, tools, valid_names):
+    """Route one decomposed sub-query. Returns (calls, time_ms, used_cloud,
+    hedge_report); the report is None unless the sub-query was hedged."""
+    sq_lower = sq.strip().lower()
+    if sq_lower in KEYBOARD_SHORTCUTS:
+        return [{
+            "name": "keyboard_shortcut",
+            "arguments": {"keys": KEYBOARD_SHORTCUTS[sq_lower]},
+        }], 0, False, None
+
+    probe = _SemanticProbe(sq, compile_tools(tools)) if SEMANTIC_CACHE else None
+    if probe is not None and probe.calls:
+        return probe.calls, probe.time_ms, False, None
+
+    sub_messages = [{"role": "user", "content": sq}]
+    report = None
+    if ADAPTIVE_ROUTING and get_adaptive_router().advise(sq, compile_tools(tools))["skip_local"]:
+        cloud = generate_cloud(sub_messages, tools)
+        calls, time_ms, used_cloud = cloud.get("function_calls", []), cloud.get("total_time_ms", 0), True
+    elif HEDGE_CLOUD:
+        calls, time_ms, used_cloud, report = _hedged_calls(sub_messages, tools, sq, valid_names)
+    else:
+        local, calls = _local_calls(sub_messages, tools, sq, valid_names)
+        time_ms = local.get("total_time_ms", 0)
+        used_cloud = not calls
+        if used_cloud:
+            cloud = generate_cloud(sub_messages, tools)
+            calls = cloud.get("function_calls", [])
+            time_ms += cloud.get("total_time_ms", 0)
+
+    if probe is not None:
+        probe.remember(calls)
+        time_ms += probe.time_ms
+    return calls, time_ms, used_cloud, report
+
+
+def _normalize_query(text):
+    """Loose form of a query: case-folded, single-spaced, no trailing punctuation."""
+    return " ".join(text.casefold().split()).rstrip("?.!, ")
+
+
+def _query_key(text):
+    """Cache key form of a query: whitespace collapsed, nothing else. Case and
+    punctuation can end up in arguments, so they must match exactly."""
+    return " ".join(text.split())
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key: the first caller runs the
+    function and later callers wait for it. The leader keeps the original
+    result; when anyone waited, followers each get a deep copy of a snapshot
+    taken before the leader returns, so no caller sees another's mutations."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                flight.waiters += 1
+                self.followers += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            result = copy.deepcopy(flight.result)
+            if isinstance(result, dict):
+                result["coalesced"] = True
+            return result
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            with self._lock:
+                del self._flights[key]
+            flight.error = e
+            flight.done.set()
+            raise
+        # Once the flight is unlisted nobody else can join it
+        with self._lock:
+            del self._flights[key]
+            waiters = flight.waiters
+        if waiters:
+            flight.result = copy.deepcopy(result)
+        flight.done.set()
+        return result
+
+    def stats(self):
+        with self._lock:
+            calls = self.leaders + self.followers
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.followers,
+                "in_flight": len(self._flights),
+                "coalesced_rate": self.followers / calls if calls else 0.0,
+            }
+
+
+_hybrid_flights = SingleFlight()
+_cloud_flights = SingleFlight()
+
+
+def _flight_key(messages, fingerprint):
+    """Single-flight key: tool-set fingerprint, earlier turns, exact last turn."""
+    history = hashlib.sha1(json.dumps(messages[:-1], sort_keys=True).encode()).hexdigest() if len(messages) > 1 else ""
+    last = _query_key(messages[-1]["content"]) if messages else ""
+    return f"{fingerprint}:{history}:{last}"
+
+
+def single_flight_stats():
+    """Leader and coalesced call counts at the generate_hybrid and
+    generate_cloud boundaries."""
+    return {"hybrid": _hybrid_flights.stats(), "cloud": _cloud_flights.stats()}
+
+
+def _atomic_write(path, data):
+    """Write `data` (str or bytes) to a temporary file next to `path` and
+    os.replace it into place, so readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or None)
+    try:
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class _Persistent:
+    """Batched saving for the caches and the adaptive router. Subclasses set
+    `path` and `_lock`, call `_init_persistence()` once their state exists,
+    implement `_load`, `_snapshot` (runs under `_lock`) and, unless the
+    snapshot is the file's text, `_write`, and count each update with
+    `_changed()`. The file is written every SAVE_EVERY updates and at exit;
+    a failed write (full disk, read-only path) is logged and never fails the
+    request that triggered it."""
+
+    SAVE_EVERY = 25
+
+    def _init_persistence(self):
+        self._dirty = 0
+        self._write_lock = threading.Lock()
+        if self.path:
+            self._load()
+            atexit.register(self.save)
+
+    def _changed(self):
+        """Count one update; call with `_lock` held. True when due to save."""
+        self._dirty += 1
+        return bool(self.path) and self._dirty >= self.SAVE_EVERY
+
+    def _write(self, snapshot):
+        _atomic_write(self.path, snapshot)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            snapshot = self._snapshot()
+            self._dirty = 0
+        with self._write_lock:
+            try:
+                self._write(snapshot)
+            except OSError as e:
+                logger.warning("could not save %s: %s", self.path, e)
+
+
+class ResultCache(_Persistent):
+    """Bounded LRU of generate_hybrid results with a TTL, optionally backed by a
+    JSON file so entries survive restarts. Values are stored serialized, so a
+    hit costs one json.loads and always hands back a private copy. The file is
+    rewritten every SAVE_EVERY inserts and at exit, not on every miss."""
+
+    def __init__(self, max_size=1024, ttl_s=3600, path=None):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, result_json)
+        self._lock = threading.Lock()
+        self._init_persistence()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return json.loads(entry[1])
+
+    def put(self, key, result):
+        entry = (time.time() + self.ttl_s, json.dumps(result))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            save = self._changed()
+        if save:
+            self.save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self.save()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, expires_at, result_json in stored[-self.max_size:]:
+            if expires_at > now:
+                self._entries[key] = (expires_at, result_json)
+
+    def _snapshot(self):
+        return json.dumps([[k, exp, res] for k, (exp, res) in self._entries.items()])
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL_S, RESULT_CACHE_PATH)
+        return _result_cache
+
+
+def result_cache_stats():
+    return get_result_cache().stats()
+
+
+class SemanticCache(_Persistent):
+    """Top-1 cosine index over query embeddings, stored as one contiguous,
+    L2-normalized float32 matrix. With a `path`, every SAVE_EVERY inserts and at
+    exit the matrix is written to a new `.npy` file and the row metadata to
+    `path.json`, which names that file; replacing the JSON commits both, so a
+    crash never pairs a vector with another row's name. A saved matrix is
+    memory-mapped copy-on-write when loaded. Rows are scoped by tool-set
+    fingerprint and the least recently used row is overwritten once
+    `capacity` is reached."""
+
+    def __init__(self, capacity=512, threshold=0.92, path=None):
+        try:
+            _numpy()
+        except ImportError:
+            raise RuntimeError("SemanticCache requires numpy") from None
+        self.capacity = capacity
+        self.threshold = threshold
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._matrix = None
+        self._rows = []  # per row: [fingerprint, name, text]
+        self._fp_ids = np.full(capacity, -1, dtype=np.int32)
+        self._last_used = np.zeros(capacity, dtype=np.int64)
+        self._fingerprints = {}
+        self._clock = 0
+        self._matrix_file = None  # .npy file named by path.json
+        self._lock = threading.Lock()
+        self._init_persistence()
+
+    def _fp_id(self, fingerprint):
+        return self._fingerprints.setdefault(fingerprint, len(self._fingerprints))
+
+    def _allocate(self, dim):
+        self._matrix = np.zeros((self.capacity, dim), dtype=np.float32)
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def lookup(self, vector, fingerprint):
+        """Return (name, similarity) of the best row above threshold, else None."""
+        q = self._normalize(vector)
+        with self._lock:
+            fp_id = self._fingerprints.get(fingerprint)
+            n = len(self._rows)
+            if fp_id is None or n == 0 or q.shape[0] != self._matrix.shape[1]:
+                self.misses += 1
+                return None
+            sims = self._matrix[:n] @ q
+            sims[self._fp_ids[:n] != fp_id] = -1.0
+            best = int(np.argmax(sims))
+            score = float(sims[best])
+            if score < self.threshold:
+                self.misses += 1
+                return None
+            self._clock += 1
+            self._last_used[best] = self._clock
+            self.hits += 1
+            return self._rows[best][1], score
+
+    def add(self, vector, fingerprint, name, text):
+        v = self._normalize(vector)
+        with self._lock:
+            if self._matrix is None:
+                self._allocate(v.shape[0])
+            elif v.shape[0] != self._matrix.shape[1]:
+                return
+            n = len(self._rows)
+            row = n if n < self.capacity else int(np.argmin(self._last_used))
+            self._matrix[row] = v
+            self._clock += 1
+            self._last_used[row] = self._clock
+            self._fp_ids[row] = self._fp_id(fingerprint)
+            if row == n:
+                self._rows.append([fingerprint, name, text])
+            else:
+                self._rows[row] = [fingerprint, name, text]
+            save = self._changed()
+        if save:
+            self.save()
+
+    def rebuild(self, vectors, rows):
+        """Replace the whole index in one batch. `rows` holds a
+        (fingerprint, name, text) tuple per vector; extra rows are dropped."""
+        rows = list(rows)[:self.capacity]
+        matrix = self._normalize(vectors)[:len(rows)] if rows else None
+        with self._lock:
+            self._rows = [list(r) for r in rows]
+            self._fingerprints = {}
+            self._fp_ids[:] = -1
+            self._last_used[:] = 0
+            self._clock = len(rows)
+            if matrix is not None:
+                if self._matrix is None or self._matrix.shape[1] != matrix.shape[1]:
+                    self._allocate(matrix.shape[1])
+                self._matrix[:len(rows)] = matrix
+                self._last_used[:len(rows)] = np.arange(1, len(rows) + 1)
+                for i, (fingerprint, _, _) in enumerate(rows):
+                    self._fp_ids[i] = self._fp_id(fingerprint)
+        self.save()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._rows), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+    def _load(self):
+        try:
+            with open(self.path + ".json") as f:
+                stored = json.load(f)
+            matrix_file, rows = stored["matrix"], stored["rows"]
+            matrix = None
+            if matrix_file is not None:
+                matrix = np.load(os.path.join(os.path.dirname(self.path), matrix_file), mmap_mode="c")
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        if matrix is None or matrix.shape[0] != self.capacity:
+            return
+        self._matrix = matrix
+        self._matrix_file = matrix_file
+        self._rows = rows[:self.capacity]
+        self._clock = len(self._rows)
+        for i, (fingerprint, _, _) in enumerate(self._rows):
+            self._fp_ids[i] = self._fp_id(fingerprint)
+            self._last_used[i] = i + 1
+
+    def _snapshot(self):
+        rows = [list(r) for r in self._rows]
+        return rows, None if self._matrix is None else np.array(self._matrix)
+
+    def _write(self, snapshot):
+        rows, matrix = snapshot
+        directory = os.path.dirname(self.path)
+        matrix_file = None
+        try:
+            if matrix is not None:
+                fd, matrix_path = tempfile.mkstemp(
+                    suffix=".npy", prefix=os.path.basename(self.path) + ".", dir=directory or None)
+                matrix_file = os.path.basename(matrix_path)
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, matrix)
+            _atomic_write(self.path + ".json", json.dumps({"matrix": matrix_file, "rows": rows}))
+        except BaseException:
+            self._remove(matrix_file)
+            raise
+        stale, self._matrix_file = self._matrix_file, matrix_file
+        if stale != matrix_file:
+            self._remove(stale)
+
+    def _remove(self, matrix_file):
+        if matrix_file:
+            try:
+                os.remove(os.path.join(os.path.dirname(self.path), matrix_file))
+            except OSError:
+                pass
+
+
+_semantic_cache = None
+
+
+def get_semantic_cache():
+    global _semantic_cache
+    with _result_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_PATH)
+        return _semantic_cache
+
+
+def _get_embed_model():
+    """FunctionGemma handle reserved for embeddings while PREFIX_CACHE is on.
+    Embedding runs through a handle's KV cache, so borrowing a completion
+    handle would evict the prefix kept there. Call with _embed_lock held."""
+    global _embed_model
+    if _embed_model is None:
+        _embed_model = _local_backend.init(functiongemma_path)
+    return _embed_model
+
+
+def _embed(texts):
+    """Embed `texts` on a pooled handle, or with PREFIX_CACHE on the
+    embedding handle, one caller at a time."""
+    if not PREFIX_CACHE:
+        with _checkout_model() as model:
+            return [_local_backend.embed(model, t) for t in texts]
+    with _embed_lock:
+        model = _get_embed_model()
+        return [_local_backend.embed(model, t) for t in texts]
+
+
+def rebuild_semantic_cache(entries):
+    """Batch-rebuild the semantic cache from (query, tools, function_name) entries."""
+    entries = list(entries)
+    vectors = _embed([query for query, _, _ in entries])
+    rows = [(compile_tools(tools).fingerprint, name, query) for query, tools, name in entries]
+    get_semantic_cache().rebuild(vectors, rows)
+
+
+class _SemanticProbe:
+    """Embedding of one query plus, on a hit, the slot-filled calls to reuse."""
+
+    __slots__ = ("query", "fingerprint", "vector", "calls", "score", "time_ms")
+
+    def __init__(self, query, compiled):
+        start = time.perf_counter()
+        self.query = query
+        self.fingerprint = compiled.fingerprint
+        with _stage("embedding"):
+            self.vector = _embed([query])[0]
+        self.calls = None
+        self.score = 0.0
+        with _stage("cache_lookup"):
+            hit = get_semantic_cache().lookup(self.vector, self.fingerprint)
+        if hit is not None and hit[0] in compiled.valid_names:
+            name, self.score = hit
+            with _stage("slot_filling"):
+                call = _fix_arguments_from_query({"name": name, "arguments": {}}, query)
+            complete = all(k in call["arguments"] for k in compiled.required.get(name, ()))
+            with _stage("validation"):
+                valid = complete and _validate_call(call) and _sanity_check(call, query)
+            if valid:
+                self.calls = [call]
+        self.time_ms = (time.perf_counter() - start) * 1000
+
+    def remember(self, calls):
+        """Index the query when it routed to exactly one slot-filled tool."""
+        if self.calls is None and len(calls) == 1 and calls[0].get("name") in SLOT_FILLED_TOOLS:
+            get_semantic_cache().add(self.vector, self.fingerprint, calls[0]["name"], self.query)
+
+
+def semantic_cache_stats():
+    return get_semantic_cache().stats()
+
+
+class AdaptiveRouter(_Persistent):
+    """Online estimate of whether FunctionGemma's answer to a query will be
+    rejected, from exponentially decaying counters.
+
+    Each query maps to a few features (likely tool, length bucket, leading
+    verb, digits). Every on-device attempt adds its outcome and latency to
+    each feature's counters, and every cloud call to a global latency
+    average; older observations lose half their weight every `half_life`
+    observations. Per-feature failure rates, smoothed toward the global rate,
+    are combined naive-Bayes style in log-odds. `advise` skips the local
+    attempt when local_ms + p_fail * cloud_ms > cloud_ms, once there are
+    `min_weight` observations. With a `path`, the counters are saved as JSON
+    and reloaded on restart.
+    """
+
+    PRIOR_WEIGHT = 2.0  # pseudo-observations pulling sparse features to the global rate
+
+    def __init__(self, half_life=200, min_weight=10, explore=0.05, path=None):
+        self.half_life = half_life
+        self.min_weight = min_weight
+        self.explore = explore
+        self.path = path
+        self.tick = 0
+        self._features = {}     # feature -> [tick, weight, failures, local_ms_sum]
+        self._cloud = [0, 0.0, 0.0]  # [tick, weight, cloud_ms_sum]
+        self.skipped = 0
+        self.explored = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+        self._init_persistence()
+
+    def features(self, query, compiled):
+        words = _WORD_RE.findall(query.lower())
+        scores = {name: len(kw.intersection(words)) for name, kw in compiled.keywords.items()}
+        best = max(scores, key=scores.get, default=None)
+        tool = best if best is not None and scores[best] > 0 else "<none>"
+        n = len(words)
+        length = "1-3" if n <= 3 else "4-6" if n <= 6 else "7-12" if n <= 12 else "13+"
+        verb = words[0] if words and words[0] in ACTION_VERBS else "<other>"
+        return ["all", f"tool:{tool}", f"words:{length}", f"verb:{verb}",
+                f"digits:{int(any(w.isdigit() for w in words))}"]
+
+    def _decayed(self, entry):
+        """Bring `entry` (tick first) to the current tick in place."""
+        factor = 0.5 ** ((self.tick - entry[0]) / self.half_life)
+        entry[0] = self.tick
+        for i in range(1, len(entry)):
+            entry[i] *= factor
+        return entry
+
+    def record_local(self, query, compiled, failed, time_ms):
+        keys = self.features(query, compiled)
+        with self._lock:
+            self.tick += 1
+            for key in keys:
+                entry = self._decayed(self._features.setdefault(key, [self.tick, 0.0, 0.0, 0.0]))
+                entry[1] += 1
+                entry[2] += failed
+                entry[3] += time_ms
+            save = self._changed()
+        if save:
+            self.save()
+
+    def record_cloud(self, time_ms):
+        with self._lock:
+            entry = self._decayed(self._cloud)
+            entry[1] += 1
+            entry[2] += time_ms
+
+    def advise(self, query, compiled):
+        """{"skip_local", "p_fail", "local_ms", "cloud_ms", "weight"} for `query`."""
+        keys = self.features(query, compiled)
+        with self._lock:
+            entries = [self._decayed(self._features[k]) for k in keys[1:] if k in self._features]
+            overall = self._decayed(self._features.get("all", [self.tick, 0.0, 0.0, 0.0]))
+            cloud = self._decayed(self._cloud)
+        weight = overall[1]
+        cloud_ms = cloud[2] / cloud[1] if cloud[1] else 0.0
+        advice = {"skip_local": False, "p_fail": 0.0, "local_ms": 0.0, "cloud_ms": cloud_ms, "weight": weight}
+        if weight < self.min_weight or not cloud_ms:
+            return advice
+
+        prior = min(max(overall[2] / weight, 0.01), 0.99)
+        log_odds = math.log(prior / (1 - prior))
+        local_ms, local_weight = overall[3], weight
+        for _, w, failures, local_sum in entries:
+            p = min(max((failures + self.PRIOR_WEIGHT * prior) / (w + self.PRIOR_WEIGHT), 0.01), 0.99)
+            log_odds += math.log(p / (1 - p)) - math.log(prior / (1 - prior))
+            local_ms += local_sum
+            local_weight += w
+        p_fail = 1 / (1 + math.exp(-log_odds))
+        local_ms /= local_weight
+        advice.update(p_fail=p_fail, local_ms=local_ms)
+        if local_ms + p_fail * cloud_ms > cloud_ms:
+            with self._lock:
+                if self._rng.random() < self.explore:
+                    self.explored += 1
+                else:
+                    self.skipped += 1
+                    advice["skip_local"] = True
+        return advice
+
+    def stats(self):
+        with self._lock:
+            features = {}
+            for key, entry in self._features.items():
+                _, weight, failures, local_sum = self._decayed(entry)
+                features[key] = {
+                    "weight": weight,
+                    "failure_rate": failures / weight if weight else 0.0,
+                    "local_ms": local_sum / weight if weight else 0.0,
+                }
+            cloud = self._decayed(self._cloud)
+            return {
+                "observations": self.tick,
+                "skipped": self.skipped,
+                "explored": self.explored,
+                "cloud_ms": cloud[2] / cloud[1] if cloud[1] else 0.0,
+                "features": features,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.tick, self._features, self._cloud = 0, {}, [0, 0.0, 0.0]
+            self.skipped = self.explored = 0
+        self.save()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.tick = stored.get("tick", 0)
+        self._features = stored.get("features", {})
+        self._cloud = stored.get("cloud", [self.tick, 0.0, 0.0])
+
+    def _snapshot(self):
+        return json.dumps({"tick": self.tick, "features": self._features, "cloud": self._cloud})
+
+
+_adaptive_router = None
+_adaptive_router_lock = threading.Lock()
+
+
+def get_adaptive_router():
+    global _adaptive_router
+    with _adaptive_router_lock:
+        if _adaptive_router is None:
+            _adaptive_router = AdaptiveRouter(ADAPTIVE_HALF_LIFE, ADAPTIVE_MIN_WEIGHT, ADAPTIVE_EXPLORE, ADAPTIVE_PATH)
+        return _adaptive_router
+
+
+def set_adaptive_routing(enabled=True):
+    """Kill switch for adaptive routing. Statistics are kept, so turning it
+    back on resumes from where it left off."""
+    global ADAPTIVE_ROUTING
+    ADAPTIVE_ROUTING = enabled
+
+
+def adaptive_routing_stats():
+    return get_adaptive_router().stats()
+
+
 def generate_hybrid(messages, tools, confidence_threshold=0.99):
     """Hybrid inference: FunctionGemma (on-device) for intent classification,
     with rule-based argument extraction as post-processor.
@@ -348,84 +2400,157 @@ def generate_hybrid(messages, tools, confidence_threshold=0.99):
         5. Cloud fallback — Gemini Flash when on-device fails validation
 
     FunctionGemma always runs first. Regex is never used for function selection.
+    With HEDGE_CLOUD, Gemini may be started alongside it and win the race; the
+    result then carries a "hedge" report. With PARALLEL_SUBQUERIES, sub-queries
+    run concurrently on the model pool and the reported time is that of the
+    slowest sub-query. With RESULT_CACHE, repeated queries are answered from
+    the result cache with source "cache"; with SEMANTIC_CACHE, paraphrases of a
+    routed query reuse its function name with source "semantic cache". With
+    ADAPTIVE_ROUTING, queries whose local answer is likely to be rejected go
+    straight to Gemini with source "cloud (adaptive)".
+
+    Tool lists are compiled once and recognised by identity afterwards, so
+    change a tool by passing a new dict, never by editing one in place.
+
+    Every result carries "stage_timings_ms", which is also handed to the hook
+    installed with set_tracer, and "runtime_metrics", the Cactus performance
+    counters summed over every FunctionGemma call made for the query.
+
+    With SINGLE_FLIGHT, a call arriving while an identical one (same query
+    text up to whitespace, history and tool set) is in progress waits for it
+    and returns a copy of its result marked "coalesced"; only the leader
+    reaches the tracer.
     """
+    if SINGLE_FLIGHT:
+        key = _flight_key(messages, compile_tools(tools).fingerprint)
+        return _hybrid_flights.do(key, _generate_hybrid, messages, tools)
+    return _generate_hybrid(messages, tools)
+
+
+def _generate_hybrid(messages, tools):
+    trace = StageTrace()
+    previous = getattr(_trace_local, "trace", None)
+    _trace_local.trace = trace
+    try:
+        result = _cached_route(messages, tools)
+    finally:
+        _trace_local.trace = previous
+
+    result["stage_timings_ms"] = trace.finish()
+    result["runtime_metrics"] = trace.runtime_metrics()
+    tracer = _tracer
+    if tracer is not None:
+        tracer(result["stage_timings_ms"], result)
+    return result
+
+
+def _cached_route(messages, tools):
+    cache_key = None
+    if RESULT_CACHE and len(messages) == 1:
+        start = time.perf_counter()
+        with _stage("cache_lookup"):
+            cache_key = compile_tools(tools).fingerprint + ":" + _query_key(messages[-1]["content"])
+            cached = get_result_cache().get(cache_key)
+        if cached is not None:
+            cached["cached_source"] = cached.get("source")
+            cached["source"] = "cache"
+            cached["total_time_ms"] = (time.perf_counter() - start) * 1000
+            return cached
+
+    result = _route_hybrid(messages, tools)
+    if cache_key is not None and result.get("function_calls"):
+        get_result_cache().put(cache_key, result)
+    return result
+
+
+def _route_single(messages, tools, user_msg, valid_names):
+    """Single-intent routing: FunctionGemma, then cloud fallback or hedge, or
+    straight to the cloud when the adaptive router expects that to be faster."""
+    if ADAPTIVE_ROUTING:
+        advice = get_adaptive_router().advise(user_msg, compile_tools(tools))
+        if advice["skip_local"]:
+            cloud = generate_cloud(messages, tools)
+            cloud["source"] = "cloud (adaptive)"
+            cloud["adaptive"] = advice
+            return cloud
+    if HEDGE_CLOUD:
+        calls, time_ms, used_cloud, report = _hedged_calls(messages, tools, user_msg, valid_names)
+        return {
+            "function_calls": calls,
+            "total_time_ms": time_ms,
+            "confidence": 0.9,
+            "source": "cloud (fallback)" if used_cloud else "on-device",
+            "hedge": report,
+        }
+    local, fixed_calls = _local_calls(messages, tools, user_msg, valid_names)
+    local["function_calls"] = fixed_calls
+    if local["function_calls"]:
+        local["source"] = "on-device"
+        return local
+    cloud = generate_cloud(messages, tools)
+    cloud["source"] = "cloud (fallback)"
+    cloud["total_time_ms"] += local["total_time_ms"]
+    return cloud
+
+
+def _route_hybrid(messages, tools):
+    """Uncached body of generate_hybrid."""
     user_msg = messages[-1]["content"] if messages else ""
-    sub_queries = _decompose_query(user_msg)
+    with _stage("decomposition"):
+        sub_queries = _decompose_query(user_msg)
     if len(sub_queries) > 1:
-        sub_queries = _resolve_pronouns(sub_queries)
+        with _stage("pronoun_resolution"):
+            sub_queries = _resolve_pronouns(sub_queries)
 
-    valid_names = {t["name"] for t in tools}
+    compiled = compile_tools(tools)
+    valid_names = compiled.valid_names
 
     # Single intent — normal path
     if len(sub_queries) <= 1:
-        local = generate_cactus(messages, tools)
-        fixed_calls = []
-        for c in local["function_calls"]:
-            if c.get("name") not in valid_names:
-                continue
-            c = _fix_arguments_from_query(c, user_msg)
-            if _validate_call(c) and _sanity_check(c, user_msg):
-                fixed_calls.append(c)
-        local["function_calls"] = fixed_calls
-        if local["function_calls"]:
-            local["source"] = "on-device"
-            return local
-        cloud = generate_cloud(messages, tools)
-        cloud["source"] = "cloud (fallback)"
-        cloud["total_time_ms"] += local["total_time_ms"]
-        return cloud
-
-    # Rule-based shortcuts for simple keyboard actions (no model call needed)
-    KEYBOARD_SHORTCUTS = {
-        "enter": "Return", "press enter": "Return", "hit enter": "Return",
-        "tab": "Tab", "press tab": "Tab",
-        "escape": "Escape", "press escape": "Escape",
-    }
+        probe = _SemanticProbe(user_msg, compiled) if SEMANTIC_CACHE else None
+        if probe is not None and probe.calls:
+            return {
+                "function_calls": probe.calls,
+                "total_time_ms": probe.time_ms,
+                "confidence": probe.score,
+                "source": "semantic cache",
+            }
+        result = _route_single(messages, tools, user_msg, valid_names)
+        if probe is not None:
+            probe.remember(result["function_calls"])
+            result["total_time_ms"] += probe.time_ms
+        return result
 
     # Multi-intent — per-sub-query with cloud fallback
-    all_calls = []
-    total_time = 0
-    used_cloud = False
-    for sq in sub_queries:
-        sq_lower = sq.strip().lower()
-        if sq_lower in KEYBOARD_SHORTCUTS:
-            all_calls.append({
-                "name": "keyboard_shortcut",
-                "arguments": {"keys": KEYBOARD_SHORTCUTS[sq_lower]},
-            })
-            continue
-
-        sub_messages = [{"role": "user", "content": sq}]
-        local = generate_cactus(sub_messages, tools)
-        total_time += local.get("total_time_ms", 0)
-        valid_calls = []
-        for c in local["function_calls"]:
-            if c.get("name") not in valid_names:
-                continue
-            c = _fix_arguments_from_query(c, sq)
-            if _validate_call(c) and _sanity_check(c, sq):
-                valid_calls.append(c)
-        if valid_calls:
-            all_calls.extend(valid_calls)
-        else:
-            used_cloud = True
-            cloud = generate_cloud(sub_messages, tools)
-            total_time += cloud.get("total_time_ms", 0)
-            all_calls.extend(cloud.get("function_calls", []))
+    if PARALLEL_SUBQUERIES:
+        executor = _get_subquery_executor()
+        trace = _current_trace()
+        futures = [executor.submit(_in_trace, trace, _route_subquery, sq, tools, valid_names) for sq in sub_queries]
+        routed = [f.result() for f in futures]
+        total_time = max(time_ms for _, time_ms, _, _ in routed)
+    else:
+        routed = [_route_subquery(sq, tools, valid_names) for sq in sub_queries]
+        total_time = sum(time_ms for _, time_ms, _, _ in routed)
+
+    all_calls = [c for calls, _, _, _ in routed for c in calls]
+    used_cloud = any(cloud_used for _, _, cloud_used, _ in routed)
+    reports = [report for _, _, _, report in routed if report is not None]
 
     if all_calls:
-        return {
+        result = {
             "function_calls": all_calls,
             "total_time_ms": total_time,
             "confidence": 0.9,
             "source": "cloud (fallback)" if used_cloud else "on-device",
         }
-
-    # Everything failed
-    cloud = generate_cloud(messages, tools)
-    cloud["source"] = "cloud (fallback)"
-    cloud["total_time_ms"] += total_time
-    return cloud
+    else:
+        # Everything failed
+        result = generate_cloud(messages, tools)
+        result["source"] = "cloud (fallback)"
+        result["total_time_ms"] += total_time
+    if reports:
+        result["hedge"] = _merge_hedge_reports(reports, PARALLEL_SUBQUERIES)
+    return result
 
 
 def print_result(label, result):
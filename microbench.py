@@ -0,0 +1,229 @@
+"""
+Microbenchmarks for the pure-Python routing stages in main.py.
+
+Runs decomposition, pronoun resolution, JSON repair, argument fixing,
+slot filling, validation, the sanity check and tool-index ranking over synthetic query corpora
+(short commands, long dictated text, chains of many conjunctions). Needs
+neither the Cactus runtime, model weights nor network access.
+
+Usage:
+    python microbench.py                      # report ops/sec and allocations
+    python microbench.py --save-baseline      # record microbench_baseline.json
+    python microbench.py --check              # fail on regression vs baseline
+"""
+
+import argparse, json, os, platform, random, sys, time, tracemalloc
+
+from main import (
+    _decompose_query, _resolve_pronouns, _repair_json, _fix_arguments,
+    _fix_arguments_from_query, _validate_call, _sanity_check, compile_tools,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "microbench_baseline.json")
+
+
+############## Synthetic corpora ##############
+
+NAMES = ["Alice", "Bob", "Laura", "Jake", "Priya", "Chen", "Tom", "Sarah"]
+CITIES = ["London", "San Francisco", "Paris", "Tokyo", "New York", "Seattle"]
+SONGS = ["Bohemian Rhapsody", "jazz", "lo-fi beats", "summer hits", "classical music"]
+WORDS = ("the quick brown fox jumps over a lazy dog while we talk about lunch plans "
+         "and the report that is due on friday so please remember to bring snacks").split()
+
+COMMANDS = [
+    ("get_weather", "What's the weather in {city}?"),
+    ("set_alarm", "Set an alarm for {hour}:{minute:02d} {ampm}"),
+    ("set_timer", "Set a timer for {minutes} minutes"),
+    ("play_music", "Play {song}"),
+    ("send_message", "Send a message to {name} saying {text}"),
+    ("search_contacts", "Find {name} in my contacts"),
+    ("create_reminder", "Remind me about {text} at {hour}:00 {ampm}"),
+]
+
+CONNECTORS = [" and ", ", ", " then ", " also ", " plus "]
+
+# One schema per command tool, for the tool-index stage
+TOOLS = [
+    {"name": tool, "description": template.replace("{", "").replace("}", ""),
+     "parameters": {"type": "object", "properties": {}, "required": []}}
+    for tool, template in COMMANDS
+]
+
+
+def _fill(rng, template):
+    return template.format(
+        city=rng.choice(CITIES), hour=rng.randint(1, 12), minute=rng.choice([0, 15, 30, 45]),
+        ampm=rng.choice(["AM", "PM"]), minutes=rng.randint(1, 90), song=rng.choice(SONGS),
+        name=rng.choice(NAMES), text=" ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))),
+    )
+
+
+def build_corpus(size=2000, seed=1234):
+    """Deterministic mix of (query, tool_name) pairs across three query shapes."""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        shape = i % 3
+        tool, template = rng.choice(COMMANDS)
+        if shape == 0:
+            query = _fill(rng, template)
+        elif shape == 1:
+            # Long dictated text: a message body of 40-120 words
+            body = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120)))
+            tool, query = "send_message", f"Send a message to {rng.choice(NAMES)} saying {body}"
+        else:
+            # Many conjunctions: 4-10 chained intents, some with pronouns
+            parts = []
+            for _ in range(rng.randint(4, 10)):
+                _, t = rng.choice(COMMANDS)
+                parts.append(_fill(rng, t).replace(rng.choice(NAMES), rng.choice(["him", "her"]), 1))
+            query = parts[0] + "".join(rng.choice(CONNECTORS) + p[0].lower() + p[1:] for p in parts[1:])
+        corpus.append((query, tool))
+    return corpus
+
+
+def build_raw_outputs(corpus, seed=1234):
+    """FunctionGemma-style raw outputs with the defects _repair_json handles."""
+    rng = random.Random(seed)
+    raws = []
+    for query, tool in corpus:
+        args = f'"hour":0{rng.randint(1, 9)},"minute":0{rng.randint(0, 5)}'
+        if rng.random() < 0.3:
+            args = args.replace(":", "：", 1)
+        if rng.random() < 0.3:
+            args += f',"title":"<escape>{query[:40]}<escape>"'
+        raws.append('{"function_calls":[{"name":"%s","arguments":{%s}}],"confidence":0.9}' % (tool, args))
+    return raws
+
+
+############## Stages ##############
+
+def build_stages(corpus):
+    """(name, items, fn) per stage; fn(item) runs the stage on one input."""
+    queries = [q for q, _ in corpus]
+    pairs = [(q, t) for q, t in corpus]
+    decomposed = [_decompose_query(q) for q in queries]
+    multi = [d for d in decomposed if len(d) > 1]
+    raws = build_raw_outputs(corpus)
+    calls = [
+        {"name": t, "arguments": {"hour": -7, "minute": 30, "song": " jazz. ", "location": f"{q[:20]}?"}}
+        for q, t in pairs
+    ]
+    filled = [_fix_arguments_from_query({"name": t, "arguments": {}}, q) for q, t in pairs]
+    checked = list(zip(filled, queries))
+    index = compile_tools(TOOLS).index
+
+    return [
+        ("decompose_query", queries, _decompose_query),
+        ("resolve_pronouns", multi, _resolve_pronouns),
+        ("repair_json", raws, _repair_json),
+        # _fix_arguments edits calls in place; give every op a fresh copy
+        ("fix_arguments", calls, lambda c: _fix_arguments([{**c, "arguments": dict(c["arguments"])}])),
+        ("fix_arguments_from_query", pairs, lambda p: _fix_arguments_from_query({"name": p[1], "arguments": {}}, p[0])),
+        ("validate_call", filled, _validate_call),
+        ("sanity_check", checked, lambda p: _sanity_check(*p)),
+        ("tool_index_top_k", queries, lambda q: index.top_k(q, 3)),
+    ]
+
+
+def time_stage(items, fn, min_time_s=0.5):
+    """Ops/sec over whole passes of `items`, repeated for at least `min_time_s`."""
+    ops = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time_s:
+        for item in items:
+            fn(item)
+        ops += len(items)
+        elapsed = time.perf_counter() - start
+    return ops / elapsed
+
+
+def alloc_stage(items, fn, sample=500):
+    """Mean transient (peak) bytes per op via tracemalloc, and blocks still
+    allocated per op after a pass (non-zero means the stage retains memory)."""
+    items = items[:sample]
+    tracemalloc.start()
+    try:
+        peak_total = 0
+        for item in items:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            fn(item)
+            _, peak = tracemalloc.get_traced_memory()
+            peak_total += peak - before
+    finally:
+        tracemalloc.stop()
+    blocks_before = sys.getallocatedblocks()
+    for item in items:
+        fn(item)
+    blocks = max(0, sys.getallocatedblocks() - blocks_before)
+    return peak_total / len(items), blocks / len(items)
+
+
+def run_microbench(size=2000, min_time_s=0.5):
+    corpus = build_corpus(size)
+    results = {}
+    print(f"  {'Stage':<26} {'inputs':>7} {'ops/sec':>12} {'bytes/op':>10} {'retained/op':>12}")
+    for name, items, fn in build_stages(corpus):
+        for item in items[:50]:
+            fn(item)  # warm the regex cache
+        ops_per_sec = time_stage(items, fn, min_time_s)
+        bytes_per_op, retained_blocks_per_op = alloc_stage(items, fn)
+        results[name] = {
+            "inputs": len(items),
+            "ops_per_sec": ops_per_sec,
+            "bytes_per_op": bytes_per_op,
+            "retained_blocks_per_op": retained_blocks_per_op,
+        }
+        print(f"  {name:<26} {len(items):>7} {ops_per_sec:>12.0f} {bytes_per_op:>10.0f} {retained_blocks_per_op:>12.2f}")
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Stages whose throughput dropped, or transient allocation grew, by more
+    than `tolerance` (a fraction) against the baseline, plus stages the
+    baseline does not cover yet."""
+    regressions = [f"{name}: not in baseline (re-record with --save-baseline)"
+                   for name in results if name not in baseline["stages"]]
+    for name, base in baseline["stages"].items():
+        current = results.get(name)
+        if current is None:
+            continue
+        if current["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {current['ops_per_sec']:.0f} ops/sec vs baseline {base['ops_per_sec']:.0f}")
+        if current["bytes_per_op"] > base["bytes_per_op"] * (1 + tolerance) + 64:
+            regressions.append(f"{name}: {current['bytes_per_op']:.0f} bytes/op vs baseline {base['bytes_per_op']:.0f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmark the pure-Python routing stages.")
+    parser.add_argument("--size", type=int, default=2000, help="synthetic queries in the corpus")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds of timing per stage")
+    parser.add_argument("--save-baseline", action="store_true", help=f"write {os.path.basename(BASELINE_PATH)}")
+    parser.add_argument("--check", action="store_true", help="exit 1 on regression against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed fractional regression")
+    args = parser.parse_args()
+
+    results = run_microbench(args.size, args.min_time)
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "size": args.size,
+                "stages": results,
+            }, f, indent=2)
+        print(f"Baseline written to {BASELINE_PATH}")
+
+    if args.check:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"  REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline.")
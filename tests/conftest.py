@@ -0,0 +1,9 @@
+"""Offline test setup: the repo root on sys.path and FakeBackend in place of
+Cactus and Gemini, so no weights or network are needed."""
+
+import os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("HYBRID_BACKEND", "fake")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "app", "bridge"))
@@ -0,0 +1,83 @@
+import struct
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("fastapi")
+
+import server
+from server import UnsupportedAudio, decode_wav, preprocess_audio
+
+
+def _wav(payload, format_tag=1, channels=1, rate=16000, bits=16, extensible=False):
+    block = channels * bits // 8
+    fmt = struct.pack("<HHIIHH", 0xFFFE if extensible else format_tag, channels, rate,
+                      rate * block, block, bits)
+    if extensible:
+        fmt += struct.pack("<HHI", 22, bits, 0) + struct.pack("<H", format_tag) + b"\0" * 14
+    chunks = b"fmt " + struct.pack("<I", len(fmt)) + fmt
+    chunks += b"data" + struct.pack("<I", len(payload)) + payload + b"\0" * (len(payload) & 1)
+    return b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks
+
+
+@pytest.mark.parametrize("bits, payload, expected", [
+    (8, bytes([0, 128, 255]), [-1.0, 0.0, 127 / 128]),
+    (16, struct.pack("<3h", -32768, 0, 16384), [-1.0, 0.0, 0.5]),
+    (24, b"\x00\x00\x80" + b"\x00\x00\x00" + b"\x00\x00\x40", [-1.0, 0.0, 0.5]),
+    (32, struct.pack("<3i", -2**31, 0, 2**30), [-1.0, 0.0, 0.5]),
+])
+def test_decodes_pcm_widths(bits, payload, expected):
+    samples, rate = decode_wav(_wav(payload, bits=bits))
+    assert rate == 16000
+    assert samples.shape == (3, 1)
+    np.testing.assert_allclose(samples[:, 0], expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("bits, code", [(32, "<3f"), (64, "<3d")])
+def test_decodes_float(bits, code):
+    samples, _ = decode_wav(_wav(struct.pack(code, -0.5, 0.0, 0.25), format_tag=3, bits=bits))
+    assert samples.dtype == np.float32
+    np.testing.assert_allclose(samples[:, 0], [-0.5, 0.0, 0.25])
+
+
+def test_decodes_extensible_stereo_and_drops_partial_frame():
+    payload = struct.pack("<4h", 16384, -16384, 8192, -8192) + b"\x01"
+    samples, rate = decode_wav(_wav(payload, channels=2, rate=48000, extensible=True))
+    assert rate == 48000
+    np.testing.assert_allclose(samples, [[0.5, -0.5], [0.25, -0.25]])
+
+
+def test_skips_unknown_and_odd_sized_chunks():
+    wav = _wav(struct.pack("<2h", 0, 16384))
+    junk = b"LIST" + struct.pack("<I", 3) + b"abc\0"
+    wav = wav[:12] + junk + wav[12:]
+    samples, _ = decode_wav(wav)
+    np.testing.assert_allclose(samples[:, 0], [0.0, 0.5])
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"ID3\x04" + b"\0" * 40,
+    _wav(b"\0\0")[:20],                          # cut inside the fmt chunk
+    _wav(b"\0\0")[:36],                          # fmt chunk but no data chunk
+    _wav(b"\0\0", channels=0),
+    _wav(b"\0\0", rate=0),
+    _wav(b"\0\0", bits=12),
+    _wav(b"\0\0", format_tag=2),                 # ADPCM
+])
+def test_rejects_unsupported_or_truncated(data):
+    with pytest.raises(UnsupportedAudio):
+        decode_wav(data)
+
+
+def test_preprocess_reports_unsupported_audio(monkeypatch):
+    monkeypatch.setattr(server, "AFCONVERT", "/nonexistent/afconvert")
+    with pytest.raises(UnsupportedAudio):
+        preprocess_audio(b"not audio at all")
+
+
+def test_preprocess_resamples_to_16k_mono():
+    payload = np.zeros((4410, 2), dtype="<i2").tobytes()
+    pcm = preprocess_audio(_wav(payload, channels=2, rate=44100))
+    assert pcm.dtype == np.dtype("<i2")
+    assert len(pcm) == 1600
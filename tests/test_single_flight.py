@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+import main
+from main import SingleFlight
+
+
+def _run_concurrently(n, target):
+    results, errors = [None] * n, [None] * n
+
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    return threads, results, errors
+
+
+def _wait_for_followers(flights, n):
+    for _ in range(1000):
+        with flights._lock:
+            if flights.followers >= n:
+                return
+        threading.Event().wait(0.001)
+    raise AssertionError("followers never joined")
+
+
+def test_followers_get_private_copies_of_one_run():
+    flights, release, calls = SingleFlight(), threading.Event(), []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {"function_calls": [{"name": "play_music", "arguments": {"song": "jazz"}}]}
+
+    threads, results, errors = _run_concurrently(4, lambda: flights.do("k", fn))
+    _wait_for_followers(flights, 3)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert errors == [None] * 4
+    assert len(calls) == 1
+    assert sorted(bool(r.get("coalesced")) for r in results) == [False, True, True, True]
+    results[0]["function_calls"][0]["arguments"]["song"] = "changed"
+    assert sum(r["function_calls"][0]["arguments"]["song"] == "jazz" for r in results) == 3
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_leader_exception_reaches_every_follower():
+    flights, release = SingleFlight(), threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise RuntimeError("backend down")
+
+    threads, results, errors = _run_concurrently(3, lambda: flights.do("k", fn))
+    _wait_for_followers(flights, 2)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert all(isinstance(e, RuntimeError) for e in errors)
+    assert flights.stats()["in_flight"] == 0
+    # The failed flight is gone; the next call runs afresh
+    assert flights.do("k", lambda: {"ok": True}) == {"ok": True}
+
+
+def test_lone_leader_result_is_not_copied():
+    flights, result = SingleFlight(), {"function_calls": []}
+    assert flights.do("k", lambda: result) is result
+
+
+def test_generate_hybrid_coalesces_only_identical_text(monkeypatch):
+    fake = main.FakeBackend(latency_ms=200, decode_ms_per_token=0, cloud_latency_ms=0)
+    monkeypatch.setattr(main, "SINGLE_FLIGHT", True)
+    main.set_backends(fake, fake)
+    tools = [{"name": "type_text", "description": "Type text",
+              "parameters": {"type": "object", "properties": {"text": {"type": "string"}}, "required": ["text"]}}]
+    before = main.single_flight_stats()["hybrid"]
+    results = {}
+
+    def route(query):
+        results[query] = main.generate_hybrid([{"role": "user", "content": query}], tools)
+
+    # The first two differ only in spacing and share a run; the third differs in case
+    threads = [threading.Thread(target=route, args=(q,)) for q in ("type Dear Sir", "type  Dear Sir", "type dear sir")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+
+    after = main.single_flight_stats()["hybrid"]
+    assert after["leaders"] - before["leaders"] == 2
+    assert after["coalesced"] - before["coalesced"] == 1
+    assert results["type dear sir"]["function_calls"][0]["arguments"]["text"] == "dear sir"
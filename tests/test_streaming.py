@@ -0,0 +1,64 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("fastapi")
+
+from server import StreamingTranscriber, StreamResampler, WHISPER_SAMPLE_RATE
+
+
+def _stitched(committed, window):
+    stream = StreamingTranscriber(pool=None)
+    stream._committed = committed.split()
+    stream._window_words = stream._stitch(window.split())
+    return stream.text()
+
+
+@pytest.mark.parametrize("committed, window, expected", [
+    ("set an alarm for", "for seven am", "set an alarm for seven am"),
+    ("send a message to John", "to John saying hi", "send a message to John saying hi"),
+    ("open", "Safari", "open Safari"),
+    # The overlap starts inside a word, so the window's first word is a fragment
+    ("remind me to call", "all mom tonight", "remind me to call mom tonight"),
+    # The frozen window cut its last word short
+    ("open Saf", "Safari please", "open Safari please"),
+    ("play some jazz", "play some jazz music", "play some jazz music"),
+    ("what's the weather", "Weather, in Paris", "what's the weather in Paris"),
+])
+def test_stitch_drops_repeated_overlap(committed, window, expected):
+    assert _stitched(committed, window) == expected
+
+
+def test_stitch_keeps_window_without_overlap():
+    assert _stitched("open Safari", "and type hello") == "open Safari and type hello"
+    assert _stitched("", "open Safari") == "open Safari"
+
+
+def _tone(rate, seconds, channels):
+    t = np.arange(int(rate * seconds)) / rate
+    mono = (np.sin(2 * np.pi * 440 * t) * 12000).astype("<i2")
+    return np.repeat(mono[:, None], channels, axis=1).reshape(-1)
+
+
+@pytest.mark.parametrize("rate, channels", [(44100, 1), (48000, 2), (22050, 1), (16000, 2)])
+def test_resampling_is_independent_of_chunking(rate, channels):
+    frames = _tone(rate, 2, channels)
+    whole = StreamResampler(rate, channels).push(frames)
+
+    resampler, parts, i = StreamResampler(rate, channels), [], 0
+    rng = np.random.default_rng(0)
+    while i < len(frames):
+        n = int(rng.integers(1, 1500)) * channels
+        parts.append(resampler.push(frames[i:i + n]))
+        i += n
+    chunked = np.concatenate(parts)
+
+    assert len(whole) == 2 * WHISPER_SAMPLE_RATE
+    np.testing.assert_array_equal(chunked, whole)
+
+
+def test_feed_keeps_44k_duration_across_odd_chunks():
+    stream = StreamingTranscriber(pool=None, sample_rate=44100)
+    data = _tone(44100, 3, 1).tobytes()
+    for start in range(0, len(data), 1001):  # odd byte counts split frames too
+        stream.feed(data[start:start + 1001])
+    assert abs(stream.samples - 3 * WHISPER_SAMPLE_RATE) <= 1